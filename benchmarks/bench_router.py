@@ -0,0 +1,169 @@
+"""
+Routing benchmarks on synthetic route tables.
+
+    python -m benchmarks.bench_router > before.json
+    python -m benchmarks.bench_router --sizes 10 100 --matchers tree
+
+Prints one JSON document with the best time per operation of every
+(router, matcher, table, size, operation, case) so runs can be compared.
+"""
+import sys
+import json
+import uuid
+import timeit
+import argparse
+import platform
+import datetime
+
+import pibe
+from webob import Request, Response, exc
+
+USER_ID = uuid.UUID("2f1b3c4d-5e6f-4a1b-8c9d-0e1f2a3b4c5d")
+
+# one route per kind, cycled through the table
+ROUTE_KINDS = (
+    ("/r{i}/items/<item_id:int>/", lambda i: "/r{}/items/42/".format(i), {"item_id": 42}),
+    ("/r{i}/users/<user_id:uuid>/", lambda i: "/r{}/users/{}/".format(i, USER_ID), {"user_id": USER_ID}),
+    ("/r{i}/posts/<slug:slug>/", lambda i: "/r{}/posts/hello-world/".format(i), {"slug": "hello-world"}),
+    ("/r{i}/files/<file_path:path>", lambda i: "/r{}/files/a/b/c.txt".format(i), {"file_path": "a/b/c.txt"}),
+    (r"/r{i}/codes/<code:re(\d{{3}}-[a-z]+)>/", lambda i: "/r{}/codes/123-abc/".format(i), {"code": "123-abc"}),
+)
+
+STATIC_KINDS = (
+    ("/r{i}/items/", lambda i: "/r{}/items/".format(i), {}),
+    ("/r{i}/settings/profile/", lambda i: "/r{}/settings/profile/".format(i), {}),
+)
+
+# route tables, each cycling through its route kinds
+TABLES = {
+    "dynamic": ROUTE_KINDS,
+    "static": STATIC_KINDS,
+    "mixed": ROUTE_KINDS + STATIC_KINDS,
+}
+
+MATCHERS = {"regex": pibe.RegexMatcher, "tree": pibe.TreeMatcher}
+ROUTERS = {"router": pibe.Router, "json": pibe.JSONRouter}
+
+
+def endpoint(req, **kwargs):
+    return {"ok": True}
+
+
+def raw_endpoint(req, **kwargs):
+    return Response(b"ok")
+
+
+def build_router(router_class, matcher_class, size, kinds=ROUTE_KINDS):
+    router = router_class(matcher_class=matcher_class)
+    func = endpoint if router_class is pibe.JSONRouter else raw_endpoint
+    paths = []
+    for i in range(size):
+        (template, path, kwargs) = kinds[i % len(kinds)]
+        router.get(template.format(i=i), name="route{}".format(i))(func)
+        paths.append((path(i), kwargs))
+    router.freeze()
+    return (router, paths)
+
+
+def best_time(func, number, repeat):
+    timer = timeit.Timer(func)
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def resolve_case(router, method, path):
+    req = Request.blank(path, method=method)
+
+    def run():
+        try:
+            router.resolve(req)
+        except (exc.HTTPNotFound, exc.HTTPMethodNotAllowed):
+            pass
+    return run
+
+
+def application_case(router, method, path):
+    environ = Request.blank(path, method=method).environ
+
+    def start_response(status, headers, exc_info=None):
+        pass
+
+    def run():
+        app_iter = router.application(dict(environ), start_response)
+        b"".join(app_iter)
+        if hasattr(app_iter, "close"):
+            app_iter.close()
+    return run
+
+
+def reverse_case(router, name, kwargs):
+    return lambda: router.reverse(name, **kwargs)
+
+
+def bench(router_name, matcher_name, table, size, number, repeat):
+    start = timeit.default_timer()
+    (router, paths) = build_router(ROUTERS[router_name], MATCHERS[matcher_name], size, TABLES[table])
+    build_seconds = timeit.default_timer() - start
+    last = size - 1
+    cases = {
+        "hit": ("GET", paths[0][0]),
+        "late_hit": ("GET", paths[last][0]),
+        "not_found": ("GET", "/missing/path/"),
+        "method_not_allowed": ("POST", paths[last][0]),
+    }
+    benchmarks = []
+    for (case, (method, path)) in cases.items():
+        benchmarks.append(("resolve", case, resolve_case(router, method, path)))
+        benchmarks.append(("application", case, application_case(router, method, path)))
+    benchmarks.append(("reverse", "hit", reverse_case(router, "route0", paths[0][1])))
+    benchmarks.append(("reverse", "late_hit", reverse_case(router, "route{}".format(last), paths[last][1])))
+
+    # adding the routes and freezing the router happens once, at startup
+    timings = [("build", "startup", build_seconds)]
+    for (operation, case, func) in benchmarks:
+        timings.append((operation, case, best_time(func, number, repeat)))
+
+    results = []
+    for (operation, case, seconds) in timings:
+        results.append({
+            "router": router_name,
+            "matcher": matcher_name,
+            "table": table,
+            "routes": size,
+            "operation": operation,
+            "case": case,
+            "usec_per_op": round(seconds * 1e6, 3),
+            "ops_per_sec": round(1 / seconds) if seconds else None,
+        })
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000, 10000])
+    parser.add_argument("--routers", nargs="+", choices=sorted(ROUTERS), default=sorted(ROUTERS))
+    parser.add_argument("--matchers", nargs="+", choices=sorted(MATCHERS), default=sorted(MATCHERS))
+    parser.add_argument("--tables", nargs="+", choices=sorted(TABLES), default=sorted(TABLES))
+    parser.add_argument("--number", type=int, default=1000, help="calls per timing")
+    parser.add_argument("--repeat", type=int, default=5, help="timings per benchmark, the best is kept")
+    args = parser.parse_args(argv)
+
+    results = []
+    for router_name in args.routers:
+        for matcher_name in args.matchers:
+            for table in args.tables:
+                for size in args.sizes:
+                    results.extend(bench(router_name, matcher_name, table, size, args.number, args.repeat))
+
+    json.dump({
+        "date": datetime.datetime.utcnow().isoformat(),
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "number": args.number,
+        "repeat": args.repeat,
+        "results": results,
+    }, sys.stdout, indent=2)
+    sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
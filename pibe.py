@@ -1,10 +1,36 @@
+import io
 import re
+import sys
+import json
+import hashlib
+import uuid
+import decimal
+import datetime
+import time
+import bisect
+import random
+import asyncio
 import inspect
-from functools import wraps
+import logging
+from collections import OrderedDict
+from collections.abc import Iterator
+from functools import partial, wraps
 from webob import Request, Response, exc
 from webob.dec import wsgify
 
-__all__ = ("Router",)
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+__all__ = ("Router", "RegexMatcher", "TreeMatcher", "LRUCache", "RouteTimings")
+
+logger = logging.getLogger(__name__)
 
 
 var_regex = re.compile(
@@ -37,6 +63,94 @@ class DotDict(dict):
     __delattr__ = dict.__delitem__
 
 
+class FrozenDotDict(DotDict):
+    """
+    a read-only DotDict, safe to share between requests
+    """
+    def _read_only(self, *args, **kwargs):
+        raise TypeError("{} is read-only".format(type(self).__name__))
+
+    __setattr__ = __setitem__ = __delattr__ = __delitem__ = _read_only
+    update = setdefault = pop = popitem = clear = _read_only
+
+
+
+def json_default(obj):
+    if isinstance(obj, (datetime.datetime, datetime.date, datetime.time)):
+        return obj.isoformat()
+    if isinstance(obj, (decimal.Decimal, uuid.UUID)):
+        return str(obj)
+    raise TypeError("Object of type {} is not JSON serializable".format(type(obj).__name__))
+
+
+_stdlib_encoder = json.JSONEncoder(separators=(",", ":"), default=json_default)
+
+
+def stdlib_json_encoder(obj):
+    return _stdlib_encoder.encode(obj).encode("utf8")
+
+
+def orjson_encoder(obj):
+    return orjson.dumps(obj, default=json_default, option=orjson.OPT_NON_STR_KEYS)
+
+
+# encodes the JSONRouter responses into bytes, orjson is used when installed
+json_encoder = orjson_encoder if orjson else stdlib_json_encoder
+
+
+def stream_json(items, encoder, flush_size):
+    """
+    Encodes `items` as a JSON array, yielding chunks of about `flush_size` bytes.
+    """
+    chunks = [b"["]
+    size = 1
+    separator = b""
+    for item in items:
+        chunk = encoder(item)
+        chunks.append(separator)
+        chunks.append(chunk)
+        separator = b","
+        size += len(chunk) + 1
+        if size >= flush_size:
+            yield b"".join(chunks)
+            chunks = []
+            size = 0
+    chunks.append(b"]")
+    yield b"".join(chunks)
+
+
+def stream_ndjson(items, encoder, flush_size):
+    """
+    Encodes `items` as newline delimited JSON, yielding chunks of about
+    `flush_size` bytes.
+    """
+    chunks = []
+    size = 0
+    for item in items:
+        chunk = encoder(item)
+        chunks.append(chunk)
+        chunks.append(b"\n")
+        size += len(chunk) + 1
+        if size >= flush_size:
+            yield b"".join(chunks)
+            chunks = []
+            size = 0
+    if chunks:
+        yield b"".join(chunks)
+
+
+def msgpack_encoder(obj):
+    return msgpack.packb(obj, use_bin_type=True, default=json_default)
+
+
+msgpack_content_types = ("application/msgpack", "application/x-msgpack")
+
+
+stream_formats = {
+    "json": ("application/json", stream_json),
+    "ndjson": ("application/x-ndjson", stream_ndjson),
+}
+
 
 def int_converter(**kwargs):
     signed = kwargs.get("signed") in ["true", "1"]
@@ -72,7 +186,19 @@ regex_fn = {
 }
 
 
-def template_to_regex(template):
+# optional `(to_python, to_url)` pairs per converter kind, applied by routers
+# created with `typed_converters=True`
+converters = {
+    "int": (int, str),
+    "float": (float, str),
+    "year": (int, lambda value: "%04d" % value),
+    "month": (int, str),
+    "day": (int, lambda value: "%02d" % value),
+    "uuid": (uuid.UUID, str),
+}
+
+
+def template_to_regex(template, prefix=""):
     regex = ""
     last_pos = 0
     for match in var_regex.finditer(template):
@@ -84,7 +210,8 @@ def template_to_regex(template):
         kwargs = dict([[x.strip() for x in x.split("=")] for x in a_kw.split(",") if len(x.split("="))==2]) if a_kw else {}
         if kind not in regex_fn:
             raise KeyError("Unknown kind {}".format(kind))
-        expr = "(?P<%s>%s)" % (
+        expr = "(?P<%s%s>%s)" % (
+            prefix,
             var_name,
             regex_fn[kind](*args, **kwargs) if callable(regex_fn[kind]) else regex_fn[kind])
         regex += expr
@@ -94,6 +221,38 @@ def template_to_regex(template):
     return regex
 
 
+def template_parts(template):
+    """
+    Splits `template` into its static parts and the `(kind, args)` of its
+    variables.
+    """
+    parts = []
+    kinds = []
+    last_pos = 0
+    for match in var_regex.finditer(template):
+        parts.append(template[last_pos : match.start()])
+        kinds.append((match.group(2) or "default", match.group(4)))
+        last_pos = match.end()
+    parts.append(template[last_pos:])
+    return (tuple(parts), tuple(kinds))
+
+
+# the kinds accepting every value of some other kinds
+covering_kinds = {
+    "default": lambda kind: kind not in ("path", "re", "any"),
+    "path": lambda kind: kind not in ("re", "any"),
+    "str": lambda kind: kind in ("year", "month", "day", "shortuuid"),
+}
+
+
+def covers_kind(kind, other):
+    """
+    Whether a variable of `kind` accepts every value of one of `other`,
+    both being `(kind, args)` pairs.
+    """
+    return kind == other or (kind[0] in covering_kinds and covering_kinds[kind[0]](other[0]))
+
+
 def template_to_string(template):
     string = ""
     last_pos = 0
@@ -106,7 +265,516 @@ def template_to_string(template):
     return string
 
 
+def template_to_builder(template):
+    """
+    Compiles `template` into a dedicated function building its urls.
+    Values are passed through the `to_url` of their converter and checked
+    against the converter regex, raising a ValueError when they don't match.
+    """
+    fmt = ""
+    lines = []
+    namespace = {"var_names": [], "template": template}
+    last_pos = 0
+    for (n, match) in enumerate(var_regex.finditer(template)):
+        fmt += template[last_pos : match.start()].replace("%", "%%") + "%s"
+        var_name = match.group(1)
+        kind = match.group(2) or "default"
+        namespace["var_names"].append(var_name)
+        namespace["check%d" % n] = re.compile(template_to_regex(match.group(0))[1:-1]).fullmatch
+        namespace["to_url%d" % n] = converters.get(kind, (None, str))[1]
+        lines += [
+            "    v%d = kwargs[%r]" % (n, var_name),
+            "    if v%d.__class__ is not str:" % n,
+            "        v%d = to_url%d(v%d)" % (n, n, n),
+            "    if check%d(v%d) is None:" % (n, n),
+            "        raise ValueError('Invalid value %%r for %%s in %%s' %% (v%d, %r, template))" % (n, var_name),
+        ]
+        last_pos = match.end()
+    fmt += template[last_pos:].replace("%", "%%")
+
+    if not lines:
+        return lambda *args, **kwargs: template
+
+    source = "\n".join(
+        ["def builder(*args, **kwargs):",
+         "    if args:",
+         "        kwargs = dict(zip(var_names, args), **kwargs)"]
+        + lines
+        + ["    return %r %% (%s,)" % (fmt, ", ".join("v%d" % n for n in range(len(namespace["var_names"]))))]
+    )
+    exec(source, namespace)
+    return namespace["builder"]
+
+
+def template_vars(template):
+    return [match.group(1) for match in var_regex.finditer(template)]
+
+
+def template_converters(template):
+    """
+    Returns `(var_name, (to_python, to_url))` for the variables of
+    `template` whose kind declares a conversion.
+    """
+    return [
+        (match.group(1), converters[match.group(2)])
+        for match in var_regex.finditer(template)
+        if match.group(2) in converters
+    ]
+
+
+# backreferences and conditionals refer to group numbers, which shift once
+# a route is folded into a combined regex
+unfoldable_regex = re.compile(r"\\[1-9]|\(\?P=|\(\?\(")
+
+
+class RegexMatcher(object):
+    """
+    Matches a path against a list of routes keeping registration order.
+    Consecutive routes are folded into a single alternation regex so a
+    lookup costs one regex call per block instead of one per route.
+    """
+
+    # the re engine saves every group mark on each alternative it tries,
+    # so very large alternations get slower per route than small ones
+    block_size = 32
+
+    def __init__(self, routes):
+        self.blocks = []
+        block = []
+        for (idx, regex, pattern) in routes:
+            if self._foldable(regex, pattern):
+                block.append((idx, regex, pattern))
+                if len(block) == self.block_size:
+                    self.blocks.extend(self._fold(block))
+                    block = []
+                continue
+            if block:
+                self.blocks.extend(self._fold(block))
+                block = []
+            self.blocks.append(self._single(idx, regex))
+        if block:
+            self.blocks.extend(self._fold(block))
+
+    @staticmethod
+    def _foldable(regex, pattern):
+        return (set(regex.groupindex) == set(template_vars(pattern))
+                and not unfoldable_regex.search(regex.pattern))
+
+    @staticmethod
+    def _single(idx, regex):
+        return (idx, idx, None, [(idx, regex, None)])
+
+    def _fold(self, block):
+        if len(block) == 1:
+            return [self._single(block[0][0], block[0][1])]
+        alternatives = []
+        for (n, (idx, regex, pattern)) in enumerate(block):
+            alternatives.append("(?P<_%d>%s$)" % (
+                n, template_to_regex(pattern, prefix="_%d_" % n)[1:-1]))
+        try:
+            combined = re.compile("^(?:%s)" % "|".join(alternatives))
+        except re.error:
+            # i.e. conflicting inline flags inside re(...) converters
+            return [self._single(idx, regex) for (idx, regex, pattern) in block]
+        entries = [
+            (idx, regex, [(name, combined.groupindex["_%d_%s" % (n, name)])
+                          for name in regex.groupindex])
+            for (n, (idx, regex, pattern)) in enumerate(block)
+        ]
+        return [(block[0][0], block[-1][0], combined, entries)]
+
+    def match(self, path, start=0):
+        """
+        Returns `(idx, kwargs)` for the first route at or after `start`
+        matching `path` or None.
+        """
+        for (first, last, combined, entries) in self.blocks:
+            if last < start:
+                continue
+            if combined is None or first < start:
+                for (idx, regex, _) in entries:
+                    if idx < start:
+                        continue
+                    match = regex.match(path)
+                    if match:
+                        return (idx, match.groupdict())
+                continue
+            match = combined.match(path)
+            if match:
+                (idx, _, groups) = entries[int(match.lastgroup[1:])]
+                return (idx, dict([(name, match.group(g)) for (name, g) in groups]))
+        return None
+
+
+# converter kinds whose regex never matches a "/"; templates using any
+# other kind (i.e. `path` or `re`) are not split into segments
+segment_kinds = {
+    "default", "str", "year", "month", "day", "slug", "username", "email",
+    "uuid", "int", "float", "any", "shortuuid",
+}
+
+
+class TreeNode(object):
+    __slots__ = ("static", "dynamic", "routes", "min_idx")
+
+    def __init__(self):
+        self.static = dict()
+        self.dynamic = dict()
+        self.routes = []
+        self.min_idx = None
+
+
+class TreeMatcher(object):
+    """
+    Matches a path against a list of routes using a segment tree.
+    Templates are split on "/", static segments are looked up in a dict
+    and converter regexes only run on the segment they belong to, so the
+    lookup cost depends on the path depth rather than on the route count.
+    Templates that can't be split are handled by a `RegexMatcher`.
+    """
+
+    def __init__(self, routes):
+        self.root = TreeNode()
+        fallback = []
+        for (idx, regex, pattern) in routes:
+            if self._splittable(pattern):
+                self._insert(idx, pattern)
+            else:
+                fallback.append((idx, regex, pattern))
+        self.fallback = RegexMatcher(fallback) if fallback else None
+
+    @staticmethod
+    def _splittable(pattern):
+        for match in var_regex.finditer(pattern):
+            if (match.group(2) or "default") not in segment_kinds or "/" in match.group(0):
+                return False
+        return True
+
+    def _insert(self, idx, pattern):
+        node = self.root
+        for segment in pattern.split("/"):
+            if node.min_idx is None:
+                node.min_idx = idx
+            if var_regex.search(segment):
+                key = template_to_regex(segment)
+                if key not in node.dynamic:
+                    node.dynamic[key] = (re.compile(key), TreeNode())
+                node = node.dynamic[key][1]
+            else:
+                node = node.static.setdefault(segment, TreeNode())
+        if node.min_idx is None:
+            node.min_idx = idx
+        node.routes.append(idx)
+
+    def _lookup(self, node, segments, depth, start, limit):
+        if depth == len(segments):
+            for idx in node.routes:
+                if idx >= start:
+                    return (idx, dict()) if idx < limit else None
+            return None
+
+        found = None
+        segment = segments[depth]
+        child = node.static.get(segment)
+        if child is not None and child.min_idx < limit:
+            found = self._lookup(child, segments, depth + 1, start, limit)
+            if found:
+                limit = found[0]
+
+        for (regex, child) in node.dynamic.values():
+            if child.min_idx >= limit:
+                continue
+            match = regex.match(segment)
+            if match:
+                candidate = self._lookup(child, segments, depth + 1, start, limit)
+                if candidate:
+                    candidate[1].update(match.groupdict())
+                    found = candidate
+                    limit = candidate[0]
+        return found
+
+    def match(self, path, start=0):
+        """
+        Returns `(idx, kwargs)` for the first route at or after `start`
+        matching `path` or None.
+        """
+        found = self.fallback.match(path, start) if self.fallback else None
+        limit = found[0] if found else float("inf")
+        return self._lookup(self.root, path.split("/"), 0, start, limit) or found
+
+
+class LRUCache(object):
+    """
+    a bounded mapping that drops the least recently used entries
+    and counts its hits and misses
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        try:
+            value = self.data[key]
+            self.data.move_to_end(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self.data[key] = value
+        while len(self.data) > self.maxsize:
+            try:
+                self.data.popitem(last=False)
+            except KeyError:
+                break
+
+    def clear(self):
+        self.data.clear()
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self.data),
+            "maxsize": self.maxsize,
+        }
+
+
+def head_endpoint(func, head):
+    """
+    Wraps `func` so that HEAD requests call `head(req, **kwargs)` instead,
+    for routes able to answer them without building the whole response.
+    """
+    if _is_async(func):
+        async def endpoint(req, **kwargs):
+            resp = head(req, **kwargs) if req.method == "HEAD" else func(req, **kwargs)
+            if inspect.isawaitable(resp):
+                resp = await resp
+            return resp
+    else:
+        def endpoint(req, **kwargs):
+            if req.method == "HEAD":
+                return head(req, **kwargs)
+            return func(req, **kwargs)
+    return wraps(func)(endpoint)
+
+
+def timed_step(func, observe, phase, clock=time.perf_counter):
+    """
+    Wraps `func` so that the duration of every call is passed to
+    `observe(phase, seconds)`.
+    """
+    if _is_async(func):
+        async def step(*args, **kwargs):
+            start = clock()
+            resp = func(*args, **kwargs)
+            if inspect.isawaitable(resp):
+                resp = await resp
+            observe(phase, clock() - start)
+            return resp
+    else:
+        def step(*args, **kwargs):
+            start = clock()
+            resp = func(*args, **kwargs)
+            observe(phase, clock() - start)
+            return resp
+    return wraps(func)(step)
+
+
+class ClosingIterator(object):
+    """
+    Wraps an `app_iter` to call `callback` once the server closes it,
+    after the wrapped iterator own close.
+    """
+
+    def __init__(self, app_iter, callback):
+        self.app_iter = app_iter
+        self.callback = callback
+
+    def __iter__(self):
+        return iter(self.app_iter)
+
+    def close(self):
+        (callback, self.callback) = (self.callback, None)
+        try:
+            if hasattr(self.app_iter, "close"):
+                self.app_iter.close()
+        finally:
+            if callback is not None:
+                callback()
+
+
+def after_stream(resp, callback):
+    """
+    Calls `callback` once the body of `resp` has been sent, or right away
+    when it isn't a response.
+    """
+    if isinstance(resp, Response):
+        resp.app_iter = ClosingIterator(resp.app_iter, callback)
+    else:
+        callback()
+    return resp
+
+
+def is_streamed(resp):
+    """
+    Whether the body of `resp` is produced while it's sent: an iterator,
+    or a response (as returned by the endpoint wrappers) whose `app_iter`
+    isn't a list.
+    """
+    if isinstance(resp, Response):
+        return not isinstance(resp.app_iter, (list, tuple))
+    return isinstance(resp, Iterator)
+
+
+def versioned_endpoint(func, version_key, response_wrapper, opts):
+    """
+    Wraps `func` so that GET and HEAD requests whose `If-None-Match` holds
+    the current `version_key(req, **kwargs)` get a 304 without calling the
+    endpoint, and other methods a 412. GET and HEAD responses get the
+    version key as their ETag.
+    """
+    def check(req, kwargs):
+        key = version_key(req, **kwargs)
+        if key is None:
+            return None
+        key = str(key)
+        if key in req.if_none_match:
+            if req.method not in ("GET", "HEAD"):
+                raise exc.HTTPPreconditionFailed()
+            raise exc.HTTPNotModified(headers=[("ETag", '"{}"'.format(key))])
+        return key if req.method in ("GET", "HEAD") else None
+
+    def tag(req, resp, key):
+        resp = response_wrapper(resp, req=req, **opts)
+        if key is not None and isinstance(resp, Response):
+            resp.etag = key
+        return resp
+
+    if _is_async(func):
+        async def endpoint(req, **kwargs):
+            key = check(req, kwargs)
+            resp = func(req, **kwargs)
+            if inspect.isawaitable(resp):
+                resp = await resp
+            return tag(req, resp, key)
+    else:
+        def endpoint(req, **kwargs):
+            key = check(req, kwargs)
+            return tag(req, func(req, **kwargs), key)
+    return wraps(func)(endpoint)
+
+
+class Histogram(object):
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
+        cumulative = 0
+        buckets = []
+        for (bound, count) in zip(self.bounds + (float("inf"),), self.counts):
+            cumulative += count
+            buckets.append((bound, cumulative))
+        return {"count": self.count, "sum": self.sum, "buckets": buckets}
+
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class RouteTimings(object):
+    """
+    In-process latency histograms per route and request phase: resolve,
+    each before request function, the endpoint, each after request
+    function and the response wrapper. Only a `sample_rate` fraction of
+    the requests is timed.
+    """
+
+    bounds = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, sample_rate=1.0, bounds=None):
+        self.sample_rate = sample_rate
+        if bounds:
+            self.bounds = tuple(bounds)
+        self.histograms = dict()
+
+    def sampled(self):
+        return self.sample_rate >= 1 or random.random() < self.sample_rate
+
+    def observe(self, route, phase, value):
+        histogram = self.histograms.get((route, phase))
+        if histogram is None:
+            histogram = self.histograms.setdefault((route, phase), Histogram(self.bounds))
+        histogram.observe(value)
+
+    def snapshot(self):
+        """
+        Returns `{route: {phase: {"count", "sum", "buckets"}}}` where
+        buckets are cumulative `(upper_bound, count)` pairs.
+        """
+        snapshot = dict()
+        for ((route, phase), histogram) in list(self.histograms.items()):
+            snapshot.setdefault(route, dict())[phase] = histogram.snapshot()
+        return snapshot
+
+    def prometheus(self, metric="pibe_route_phase_seconds"):
+        """
+        Returns the histograms in the Prometheus text exposition format.
+        """
+        lines = ["# TYPE {} histogram".format(metric)]
+        for (route, phases) in sorted(self.snapshot().items()):
+            for (phase, data) in sorted(phases.items()):
+                labels = 'route="{}",phase="{}"'.format(_label(route), _label(phase))
+                for (bound, count) in data["buckets"]:
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append('{}_bucket{{{},le="{}"}} {}'.format(metric, labels, le, count))
+                lines.append("{}_sum{{{}}} {!r}".format(metric, labels, data["sum"]))
+                lines.append("{}_count{{{}}} {}".format(metric, labels, data["count"]))
+        return "\n".join(lines) + "\n"
+
+
+def _mutator(name):
+    def method(self, *args, **kwargs):
+        self._changed()
+        return getattr(list, name)(self, *args, **kwargs)
+    method.__name__ = name
+    return method
+
+
 class CallbackRegistry(list):
+    append = _mutator("append")
+    extend = _mutator("extend")
+    insert = _mutator("insert")
+    remove = _mutator("remove")
+    pop = _mutator("pop")
+    clear = _mutator("clear")
+    __setitem__ = _mutator("__setitem__")
+    __delitem__ = _mutator("__delitem__")
+    __iadd__ = _mutator("__iadd__")
+
+    def __init__(self, on_change=None):
+        self.on_change = on_change
+        super().__init__()
+
+    def _changed(self):
+        if self.on_change:
+            self.on_change()
+
     def __call__(self):
         def func_decorator(func):
             self.append(func)
@@ -114,52 +782,514 @@ class CallbackRegistry(list):
         return func_decorator
 
 
+def asgi_environ(scope, body):
+    """
+    Builds a WSGI environ out of an ASGI http scope and its request body.
+    """
+    server = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf8").decode("latin1"),
+        "PATH_INFO": scope["path"].encode("utf8").decode("latin1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": "HTTP/%s" % scope.get("http_version", "1.1"),
+        "REMOTE_ADDR": (scope.get("client") or ("", 0))[0],
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+        "asgi.scope": scope,
+    }
+    for (name, value) in scope.get("headers", []):
+        name = name.decode("latin1").upper().replace("-", "_")
+        value = value.decode("latin1")
+        if name not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            name = "HTTP_%s" % name
+        if name in environ:
+            value = "%s,%s" % (environ[name], value)
+        environ[name] = value
+    # the body is already read, its length is known
+    environ["CONTENT_LENGTH"] = str(len(body))
+    return environ
+
+
+def _as_response(req, resp):
+    # the conversions wsgify applies to the values returned by the application
+    if resp is None:
+        resp = req.response
+    if isinstance(resp, str):
+        resp = resp.encode(req.charset)
+    if isinstance(resp, bytes):
+        body = resp
+        resp = req.response
+        resp.write(body)
+    if resp is not req.response:
+        resp = req.response.merge_cookies(resp)
+    return resp
+
+
+def _is_async(func):
+    return inspect.iscoroutinefunction(inspect.unwrap(func))
+
+
+def _hook_name(func):
+    # partials and callable instances have no __name__
+    return getattr(func, "__name__", None) or type(func).__name__
+
+
 class Router(list):
-    def __init__(self):
+    matcher_class = RegexMatcher
+    frozen = False
+
+    append = _mutator("append")
+    extend = _mutator("extend")
+    insert = _mutator("insert")
+    remove = _mutator("remove")
+    pop = _mutator("pop")
+    clear = _mutator("clear")
+    sort = _mutator("sort")
+    __setitem__ = _mutator("__setitem__")
+    __delitem__ = _mutator("__delitem__")
+    __iadd__ = _mutator("__iadd__")
+
+    def __init__(self, matcher_class=None, resolve_cache_size=None, typed_converters=False):
+        if matcher_class:
+            self.matcher_class = matcher_class
+        self.typed_converters = typed_converters
+        self.resolve_cache = LRUCache(resolve_cache_size) if resolve_cache_size else None
         self.names = dict()
-        self.before_request = CallbackRegistry()
-        self.after_request = CallbackRegistry()
+        self.url_builders = dict()
+        self.duplicate_names = set()
+        self.before_request = CallbackRegistry(on_change=self._changed)
+        self.after_request = CallbackRegistry(on_change=self._changed)
+        self._method_matchers = None
+        self._path_matcher = None
+        self._allowed = None
+        self._conversions = None
+        self._pipelines = None
+        self.mounts = []
+        self.pattern_names = dict()
+        # set to a RouteTimings to time the sampled requests
+        self.timings = None
+        self._timed_pipelines = dict()
         super().__init__()
 
-    def resolve(self, req):
-        uri_matched = False
-        for (regex, resource, methods, pattern, opts) in self:
-            match = regex.match(req.path_info)
-            if match:
-                uri_matched = True
-                if req.method in methods:
-                    return (resource, match.groupdict(), opts)
+    def _changed(self):
+        if self.frozen:
+            raise RuntimeError("Router is frozen, routes and hooks can't be changed")
+        self._path_matcher = None
+
+    def compile(self):
+        by_method = dict()
+        patterns = dict()
+        for (idx, (regex, _, methods, pattern, _)) in enumerate(self):
+            for method in methods:
+                by_method.setdefault(method, []).append((idx, regex, pattern))
+            if pattern not in patterns:
+                patterns[pattern] = (idx, regex, set())
+            patterns[pattern][2].update(methods)
+
+        self._method_matchers = dict(
+            [(method, self.matcher_class(routes)) for (method, routes) in by_method.items()])
+        self._path_matcher = self.matcher_class(
+            [(idx, regex, pattern) for (pattern, (idx, regex, _)) in patterns.items()])
+        self._allowed = dict(
+            [(idx, frozenset(methods)) for (idx, _, methods) in patterns.values()])
+        self._conversions = dict()
+        if self.typed_converters:
+            for (idx, (_, _, _, pattern, _)) in enumerate(self):
+                conversions = [
+                    (var_name, to_python)
+                    for (var_name, (to_python, _)) in template_converters(pattern)
+                ]
+                if conversions:
+                    self._conversions[idx] = conversions
+        self._pipelines = [self.build_pipeline(func, opts) for (_, func, _, _, opts) in self]
+        self._timed_pipelines = dict()
+        if self.resolve_cache is not None:
+            self.resolve_cache.clear()
+        return self
+
+    def shadowed_routes(self):
+        """
+        Returns `(pattern, methods, shadowing_pattern)` for every route that
+        an earlier route always matches first: routes with the same regex,
+        static routes matched by an earlier route and dynamic routes whose
+        variables all accept fewer values than the ones of an earlier route
+        with the same static parts, like `<foo_id:int>` after `<foo_id>`.
+        """
+        shadowed = []
+        # earlier routes by regex and by static parts, and a matcher of the
+        # dynamic routes finding the earlier ones matching a static route
+        same_regex = dict()
+        same_parts = dict()
+        dynamic = TreeMatcher([
+            (idx, regex, pattern)
+            for (idx, (regex, _, _, pattern, _)) in enumerate(self)
+            if var_regex.search(pattern)
+        ])
+        for (idx, (regex, _, methods, pattern, _)) in enumerate(self):
+            earlier = same_regex.get(regex.pattern, [])
+            if not var_regex.search(pattern):
+                earlier = list(earlier)
+                start = 0
+                while True:
+                    found = dynamic.match(pattern, start)
+                    if found is None or found[0] >= idx:
+                        break
+                    (_, _, e_methods, e_pattern, _) = self[found[0]]
+                    earlier.append((found[0], e_methods, e_pattern))
+                    start = found[0] + 1
+                earlier.sort(key=lambda e: e[0])
+            else:
+                (parts, kinds) = template_parts(pattern)
+                candidates = same_parts.setdefault(parts, [])
+                covering = [
+                    (e_idx, e_methods, e_pattern)
+                    for (e_idx, e_methods, e_pattern, e_kinds) in candidates
+                    if all(map(covers_kind, e_kinds, kinds))
+                ]
+                if covering:
+                    earlier = sorted(dict([(e[0], e) for e in earlier + covering]).values(), key=lambda e: e[0])
+                candidates.append((idx, methods, pattern, kinds))
+
+            remaining = set(methods)
+            for (_, e_methods, e_pattern) in earlier:
+                covered = remaining.intersection(e_methods)
+                if covered:
+                    remaining -= covered
+                    shadowed.append((pattern, sorted(covered), e_pattern))
+                if not remaining:
+                    break
+            same_regex.setdefault(regex.pattern, []).append((idx, methods, pattern))
+        return shadowed
+
+    def freeze(self, strict=False):
+        """
+        Compiles the route table, reports shadowed routes and duplicate
+        route names and makes the route table immutable.
+        With `strict` any of those problems raises a ValueError.
+        """
+        problems = [
+            "route {} {} is shadowed by {}".format(pattern, ",".join(methods), by)
+            for (pattern, methods, by) in self.shadowed_routes()
+        ] + [
+            "route name {} is used more than once".format(name)
+            for name in sorted(self.duplicate_names)
+        ]
+        if strict and problems:
+            raise ValueError("; ".join(problems))
+        for problem in problems:
+            logger.warning(problem)
+
+        self.compile()
+        for (prefix, router) in self.mounts:
+            router.freeze(strict=strict)
+        self.frozen = True
+        # the route table can't change anymore
+        self._match = self._match_compiled
+        return self
+
+    def allowed_methods(self, path):
+        """
+        Returns the methods accepted by all the routes matching `path`.
+        """
+        if self._path_matcher is None:
+            self.compile()
+        allowed = set()
+        start = 0
+        while True:
+            found = self._path_matcher.match(path, start)
+            if found is None:
+                return allowed
+            allowed.update(self._allowed[found[0]])
+            start = found[0] + 1
+
+    def _lookup(self, method, path):
+        matcher = self._method_matchers.get(method)
+        found = matcher.match(path) if matcher else None
+        if found:
+            (idx, kwargs) = found
+            conversions = self._conversions.get(idx)
+            if conversions:
+                for (var_name, to_python) in conversions:
+                    kwargs[var_name] = to_python(kwargs[var_name])
+            return (idx, kwargs, None)
+        return (None, None, self.allowed_methods(path))
+
+    def _match(self, req):
+        if self._path_matcher is None:
+            self.compile()
+        return self._match_compiled(req)
+
+    def _match_compiled(self, req):
+        if self.resolve_cache is None:
+            (idx, kwargs, allowed) = self._lookup(req.method, req.path_info)
+        else:
+            key = (req.method, req.path_info)
+            found = self.resolve_cache.get(key)
+            if found is None:
+                found = self._lookup(req.method, req.path_info)
+                self.resolve_cache.set(key, found)
+            (idx, kwargs, allowed) = found
+            kwargs = dict(kwargs) if kwargs else {}
+
+        if idx is not None:
+            return (idx, kwargs)
 
         # we got a match in uri but not in method
-        if uri_matched:
-            raise exc.HTTPMethodNotAllowed
+        if allowed:
+            raise exc.HTTPMethodNotAllowed(headers=[("Allow", ", ".join(sorted(allowed)))])
         raise exc.HTTPNotFound
 
-    def response_wrapper(self, resp, **opts):
+    def resolve(self, req):
+        (idx, kwargs) = self._match(req)
+        (regex, resource, methods, pattern, opts) = self[idx]
+        return (resource, kwargs, opts)
+
+    def response_wrapper(self, resp, req=None, **opts):
         return resp
 
+    def route_hooks(self, registry, opts):
+        """
+        Returns the hooks of `registry` a route runs. Routes opt out of
+        every hook with `hooks=False` or of some with `exclude_hooks`.
+        """
+        if opts.get("hooks", True) == False:
+            return ()
+        exclude = opts.get("exclude_hooks")
+        if not exclude:
+            return tuple(registry)
+        return tuple([f for f in registry if getattr(f, "__name__", None) not in exclude])
+
+    def wrap_endpoint(self, func, opts):
+        """
+        Applies the route options changing how the endpoint is called:
+        `head` (a cheaper endpoint for HEAD requests) and a callable `etag`.
+        """
+        if callable(opts.get("head")):
+            func = head_endpoint(func, opts["head"])
+        if callable(opts.get("etag")):
+            func = versioned_endpoint(func, opts["etag"], self.response_wrapper, opts)
+        return func
+
+    def build_pipeline(self, func, opts, observe=None):
+        """
+        Returns the callable running a route for a request: it sets
+        `req.opts`, calls the before request functions, the endpoint, the
+        after request functions and the response wrapper. For streamed
+        results the after request functions run once the body is sent.
+        Every request gets its own copy of the route opts as `req.opts`,
+        unless the route is added with `shared_opts=True`: all its requests
+        then share the same read-only `req.opts`. With `observe`, the
+        duration of every step is passed to `observe(phase, seconds)`.
+        """
+        before = self.route_hooks(self.before_request, opts)
+        after = self.route_hooks(self.after_request, opts)
+        response_wrapper = self.response_wrapper
+        shared_opts = FrozenDotDict(opts) if opts.get("shared_opts") else None
+        func = self.wrap_endpoint(func, opts)
+        if observe is not None:
+            before = tuple([timed_step(f, observe, "before_request:" + _hook_name(f)) for f in before])
+            after = tuple([timed_step(f, observe, "after_request:" + _hook_name(f)) for f in after])
+            func = timed_step(func, observe, "endpoint")
+            response_wrapper = timed_step(response_wrapper, observe, "response_wrapper")
+
+        def run_after(req):
+            for f in after:
+                f(req)
+
+        if _is_async(func):
+            async def pipeline(req, kwargs):
+                req.opts = DotDict(opts) if shared_opts is None else shared_opts
+                for f in before:
+                    f(req)
+                resp = func(req, **kwargs)
+                if inspect.isawaitable(resp):
+                    resp = await resp
+                if is_streamed(resp):
+                    return after_stream(response_wrapper(resp, req=req, **opts), partial(run_after, req))
+                run_after(req)
+                return response_wrapper(resp, req=req, **opts)
+
+        elif not before and not after and shared_opts is not None:
+            def pipeline(req, kwargs):
+                req.opts = shared_opts
+                return response_wrapper(func(req, **kwargs), req=req, **opts)
+
+        else:
+            def pipeline(req, kwargs):
+                req.opts = DotDict(opts) if shared_opts is None else shared_opts
+
+                # call the before request functions
+                for f in before:
+                    f(req)
+
+                # call the function
+                resp = func(req, **kwargs)
+
+                # streamed bodies are produced after the endpoint returns,
+                # the after request functions are called once they're sent
+                if is_streamed(resp):
+                    return after_stream(response_wrapper(resp, req=req, **opts), partial(run_after, req))
+
+                # call the after request functions
+                run_after(req)
+
+                # finally return response
+                return response_wrapper(resp, req=req, **opts)
+
+        return pipeline
+
+    def _timed_dispatch(self, req):
+        start = time.perf_counter()
+        (idx, kwargs) = self._match(req)
+        (regex, func, methods, pattern, opts) = self[idx]
+        route = self.pattern_names.get(pattern) or pattern
+        self.timings.observe(route, "resolve", time.perf_counter() - start)
+
+        pipeline = self._timed_pipelines.get(idx)
+        if pipeline is None:
+            pipeline = self._timed_pipelines[idx] = self.build_pipeline(
+                func, opts, partial(self.timings.observe, route))
+        return pipeline(req, kwargs)
+
+    def mount(self, prefix, router):
+        """
+        Hands every request whose path starts with `prefix` to `router`,
+        with the prefix moved from `PATH_INFO` to `SCRIPT_NAME`. The
+        mounted router runs its own hooks and response wrapper. The root
+        prefix would hide every route of this router and is rejected.
+        """
+        prefix = prefix.rstrip("/")
+        if not prefix:
+            raise ValueError("Routers can't be mounted on the root path")
+        self._changed()
+        self.mounts.append((prefix, router))
+        return router
+
+    def _mounted(self, req):
+        path = req.path_info
+        for (prefix, router) in self.mounts:
+            if path.startswith(prefix) and path[len(prefix):len(prefix) + 1] in ("", "/"):
+                req.script_name += prefix
+                req.path_info = path[len(prefix):]
+                return router
+        return None
+
     @wsgify
     def application(self, req):
-        (func, kwargs, opts) = self.resolve(req)
-        req.opts = DotDict(opts)
+        if self.mounts:
+            router = self._mounted(req)
+            if router is not None:
+                return router.application(req)
+        if self.timings is not None and self.timings.sampled():
+            resp = self._timed_dispatch(req)
+        else:
+            (idx, kwargs) = self._match(req)
+            resp = self._pipelines[idx](req, kwargs)
+        if inspect.iscoroutine(resp):
+            # async endpoints served over wsgi run in their own event loop
+            resp = asyncio.run(resp)
+        return resp
+
+    # executor running the sync endpoints of the asgi application,
+    # None uses the event loop default thread pool
+    executor = None
+
+    # request bodies over this many bytes get a 413 from the asgi
+    # application, 0 disables the limit
+    max_body_size = 10 * 1024 * 1024
 
-        # call the before request functions
-        for f in self.before_request:
-            f(req)
+    async def asgi_application(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            while True:
+                message = await receive()
+                if message["type"] == "lifespan.startup":
+                    await send({"type": "lifespan.startup.complete"})
+                elif message["type"] == "lifespan.shutdown":
+                    await send({"type": "lifespan.shutdown.complete"})
+                    return
 
-        # call the function
-        resp = func(req, **kwargs)
+        chunks = []
+        size = 0
+        more_body = True
+        while more_body:
+            message = await receive()
+            chunk = message.get("body", b"")
+            size += len(chunk)
+            if self.max_body_size and size > self.max_body_size:
+                req = Request(asgi_environ(scope, b""))
+                req.response = Response()
+                return await self.asgi_send(req, exc.HTTPRequestEntityTooLarge(), send)
+            chunks.append(chunk)
+            more_body = message.get("more_body", False)
 
-        # call the after request functions
-        for f in self.after_request:
-            f(req)
+        req = Request(asgi_environ(scope, b"".join(chunks)))
+        req.response = Response()
+        try:
+            router = self
+            while router.mounts:
+                mounted = router._mounted(req)
+                if mounted is None:
+                    break
+                router = mounted
+            (idx, kwargs) = router._match(req)
+            pipeline = router._pipelines[idx]
+            if inspect.iscoroutinefunction(pipeline):
+                resp = await pipeline(req, kwargs)
+            else:
+                resp = await asyncio.get_running_loop().run_in_executor(
+                    router.executor, partial(pipeline, req, kwargs))
+        except exc.HTTPException as e:
+            resp = e
+        await self.asgi_send(req, resp, send)
 
-        # finally return response
-        return self.response_wrapper(resp, **opts)
+    async def asgi_send(self, req, resp, send):
+        started = []
+        def start_response(status, headerlist, exc_info=None):
+            started[:] = [status, headerlist]
+
+        loop = asyncio.get_running_loop()
+        app_iter = _as_response(req, resp)(req.environ, start_response)
+        try:
+            (status, headerlist) = started
+            await send({
+                "type": "http.response.start",
+                "status": int(status.split(" ", 1)[0]),
+                "headers": [(k.lower().encode("latin1"), v.encode("latin1"))
+                            for (k, v) in headerlist],
+            })
+            if isinstance(app_iter, (list, tuple)):
+                for chunk in app_iter:
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            else:
+                # streamed bodies may block while producing the next chunk
+                chunks = iter(app_iter)
+                while True:
+                    chunk = await loop.run_in_executor(self.executor, next, chunks, None)
+                    if chunk is None:
+                        break
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+        finally:
+            if hasattr(app_iter, "close"):
+                app_iter.close()
 
     def add(self, pattern, methods=["HEAD", "GET", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"], name=None, **opts):
+        if self.frozen:
+            raise RuntimeError("Router is frozen, routes can't be added")
         if name:
+            if name in self.names:
+                self.duplicate_names.add(name)
             self.names[name] = template_to_string(pattern)
+            self.url_builders[name] = template_to_builder(pattern)
+            self.pattern_names[pattern] = name
         def func_decorator(func):
             self.append((re.compile(template_to_regex(pattern)), func, methods, pattern, opts))
             return func
@@ -190,13 +1320,86 @@ class Router(list):
         return self.add(pattern, methods, name=name, **opts)
 
     def reverse(self, name, *args, **kwargs):
-        return self.names.get(name, "#unknown").format(*args, **kwargs)
+        builder = self.url_builders.get(name)
+        if builder is None:
+            return "#unknown"
+        return builder(*args, **kwargs)
+
+    def reverse_many(self, name, kwargs_list):
+        """
+        Reverses the `name` route once for every dict in `kwargs_list`.
+        """
+        builder = self.url_builders.get(name)
+        if builder is None:
+            return ["#unknown" for kwargs in kwargs_list]
+        return [builder(**kwargs) for kwargs in kwargs_list]
 
 
 class JSONRouter(Router):
-    def response_wrapper(self, resp, **opts):
+    json_encoder = staticmethod(json_encoder)
+
+    # endpoints returning a generator or any other iterator are streamed,
+    # the format and flush size can be overridden per route
+    stream_format = "json"
+    stream_flush_size = 64 * 1024
+
+    # with `etag=True` (per router or per route) responses get an ETag
+    # hashed from their body and If-None-Match requests get a 304
+    etag = False
+
+    def __init__(self, *args, json_encoder=None, **kwargs):
+        if json_encoder:
+            self.json_encoder = json_encoder
+        super().__init__(*args, **kwargs)
+
+    def response_type(self, req):
+        """
+        Returns the msgpack content type when the request asks for it and
+        msgpack is installed, else None.
+        """
+        accept = req.headers.get("Accept") if req is not None and msgpack else None
+        if not accept or "msgpack" not in accept:
+            return None
+        offers = req.accept.acceptable_offers(("application/json",) + msgpack_content_types)
+        if offers and offers[0][0] in msgpack_content_types:
+            return offers[0][0]
+        return None
+
+    def response_wrapper(self, resp, req=None, **opts):
         if type(resp) == Response:
             return resp
-        return Response(json_body=resp,
-            content_type="application/json",
-            status=opts.get("status", 200))
+        encoder = opts.get("json_encoder") or self.json_encoder
+        head = req is not None and req.method == "HEAD"
+        if isinstance(resp, Iterator):
+            (content_type, stream) = stream_formats[opts.get("stream_format") or self.stream_format]
+            if head:
+                # the length of a stream is unknown until it's sent
+                if hasattr(resp, "close"):
+                    resp.close()
+                return Response(app_iter=[], content_type=content_type, status=opts.get("status", 200))
+            return Response(
+                app_iter=stream(resp, encoder, opts.get("stream_flush_size") or self.stream_flush_size),
+                content_type=content_type,
+                status=opts.get("status", 200))
+
+        content_type = self.response_type(req) or "application/json"
+        if content_type != "application/json":
+            encoder = msgpack_encoder
+        body = encoder(resp)
+        if head:
+            # send the headers of the GET response, without its body
+            resp = Response(app_iter=[],
+                content_type=content_type,
+                content_length=len(body),
+                status=opts.get("status", 200))
+        else:
+            resp = Response(body=body,
+                content_type=content_type,
+                status=opts.get("status", 200))
+        if msgpack is not None:
+            # either format may be sent, so caches must key on Accept
+            resp.vary = ("Accept",)
+        if opts.get("etag", self.etag) == True:
+            resp.etag = hashlib.blake2b(body, digest_size=16).hexdigest()
+            resp.conditional_response = True
+        return resp
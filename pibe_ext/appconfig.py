@@ -24,6 +24,8 @@ class AppConfig(object):
         self.settings = CallbackRegistry()
         self.initialize = CallbackRegistry()
         self.wsgi_middleware = CallbackRegistry()
+        # called at the end of start_app, after every initialize callback
+        self.finalize = CallbackRegistry()
 
     def _get_funcs(self, registry, **opts):
         funcs = [f for f in registry]
@@ -56,6 +58,9 @@ class AppConfig(object):
             for func in self.wsgi_middleware:
                 app = func(app, **opts)
 
+        for func in self._get_funcs(self.finalize, **opts):
+            func(**opts)
+
         return app
 
 
@@ -1,10 +1,22 @@
+import math
+import time
+import hashlib
+import random
+import logging
 import funcy as fn
+import gevent
 import msgpack
+from collections import OrderedDict
+from urllib.parse import urlencode
 from walrus import *
+from pibe import json_default
 from .appconfig import appconfig
 from .settings import settings
+from .gl_utils import greenlet
 
-__all__ = ("cachedb", "cache", "evict")
+__all__ = ("cachedb", "cache", "evict", "invalidate", "l1cache", "cache_stats")
+
+logger = logging.getLogger(__name__)
 
 is_str = fn.isa(str)
 
@@ -16,6 +28,12 @@ def cache_settings(**opts):
         "cache_port": appconfig.env.int("REDIS_PORT", 6379),
         "cache_db": appconfig.env.int("CACHE_DB", 0),
         "cache_lock_duration": appconfig.env.int("CACHE_LOCK_DURATION", 500),  # in milliseconds
+        "cache_ttl": appconfig.env.float("CACHE_TTL", 3600),  # in seconds, 0 never expires
+        "cache_ttl_jitter": appconfig.env.float("CACHE_TTL_JITTER", 0.1),  # fraction of the ttl
+        "cache_max_size": appconfig.env.int("CACHE_MAX_SIZE", 1024 * 1024),  # in bytes, 0 disables
+        "cache_l1_size": appconfig.env.int("CACHE_L1_SIZE", 0),  # in bytes, 0 disables the L1
+        "cache_l1_ttl": appconfig.env.float("CACHE_L1_TTL", 5.0),  # in seconds
+        "cache_l1_channel": appconfig.env.str("CACHE_L1_CHANNEL", "catalog:l1:evictions"),
     }
 
 
@@ -28,54 +46,323 @@ def cachedb():
     )
 
 
-@fn.decorator
-def cache(call, *, key=None, evict_keys=None):
-    req = call._args[0]
-    key = (
-        key
-        if is_str(key)
-        else key(call)
-        if callable(key)
-        else ":".join(
-            [call._func.__name__]
-            + fn.lmap(lambda x: f"{x[0]}-{x[1]}", req.params.items())
-            + fn.lmap(lambda x: f"{x[0]}-{x[1]}", call._kwargs.items())
-        )
-    )
-    key = f"catalog:cache:{key}"
+class L1Cache(object):
+    """
+    an in-process cache of packed values in front of redis, bounded by
+    the size in bytes of its keys and values, whose entries expire after
+    `ttl` seconds
+    """
+
+    def __init__(self, max_size=0, ttl=5.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, count=True):
+        entry = self.data.get(key)
+        if entry is not None and entry[0] < time.monotonic():
+            self.delete(key)
+            entry = None
+        if entry is None:
+            self.misses += count
+            return None
+        self.data.move_to_end(key)
+        self.hits += count
+        return entry[1]
+
+    def set(self, key, value):
+        size = len(key) + len(value)
+        if size > self.max_size:
+            return
+        self.delete(key)
+        self.data[key] = (time.monotonic() + self.ttl, value)
+        self.size += size
+        while self.size > self.max_size:
+            (old_key, (_, old_value)) = self.data.popitem(last=False)
+            self.size -= len(old_key) + len(old_value)
+
+    def delete(self, key):
+        entry = self.data.pop(key, None)
+        if entry is not None:
+            self.size -= len(key) + len(entry[1])
+
+    def clear(self):
+        self.data.clear()
+        self.size = 0
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / (self.hits + self.misses) if self.hits or self.misses else 0.0,
+            "size": self.size,
+            "max_size": self.max_size,
+        }
+
+
+l1cache = L1Cache()
+l2_stats = {"hits": 0, "misses": 0}
+
+
+def cache_stats():
+    hits, misses = l2_stats["hits"], l2_stats["misses"]
+    return {
+        "l1": l1cache.stats(),
+        "l2": {"hits": hits, "misses": misses, "hit_ratio": hits / (hits + misses) if hits or misses else 0.0},
+    }
+
+
+def cache_get(key):
+    if l1cache.max_size:
+        resp = l1cache.get(key)
+        if resp is not None:
+            return resp
+
     resp = cachedb.get(key)
     if resp:
-        return msgpack.unpackb(resp, raw=False)
+        l2_stats["hits"] += 1
+        if l1cache.max_size:
+            l1cache.set(key, resp)
+    else:
+        l2_stats["misses"] += 1
+    return resp
+
+
+@greenlet()
+def l1_eviction_listener():
+    # keys evicted by any process are dropped from this process L1
+    while True:
+        try:
+            pubsub = cachedb.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(settings.cache_l1_channel)
+            # evictions may have been missed while disconnected
+            l1cache.clear()
+            for message in pubsub.listen():
+                for key in msgpack.unpackb(message["data"], raw=False):
+                    l1cache.delete(key)
+        except gevent.GreenletExit:
+            raise
+        except Exception:
+            logger.exception("L1 cache eviction listener failed, reconnecting")
+            l1cache.clear()
+            gevent.sleep(1)
+
+
+@appconfig.initialize()
+def initialize_l1_cache(**opts):
+    l1cache.max_size = settings.cache_l1_size
+    l1cache.ttl = settings.cache_l1_ttl
+    if l1cache.max_size and opts.get("l1_eviction_listener", True) == True:
+        l1_eviction_listener()
+
+
+def format_keys(keys, call):
+    keys = (
+        keys
+        if fn.is_list(keys)
+        else [keys]
+        if is_str(keys)
+        else keys(call)
+        if callable(keys)
+        else []
+    )
+    return [k.format(**call._kwargs) for k in keys]
+
+
+def default_key(call):
+    """
+    The endpoint name and a hash of its query parameters and arguments,
+    sorted so that their order doesn't matter.
+    """
+    req = call._args[0]
+    # urlencode escapes the separators, so different items can't collide
+    raw = urlencode(sorted(req.params.items())) + "#" + urlencode(sorted(call._kwargs.items()))
+    digest = hashlib.blake2b(raw.encode("utf8"), digest_size=16).hexdigest()
+    return f"{call._func.__name__}:{digest}"
+
+
+def generation_key(namespace):
+    return f"catalog:generation:{namespace}"
+
+
+def namespace_generations(namespaces):
+    """
+    Returns the current generation of every namespace, read from the L1
+    when possible and from redis in a single round trip otherwise.
+    """
+    keys = [generation_key(ns) for ns in namespaces]
+    values = [l1cache.get(k, count=False) if l1cache.max_size else None for k in keys]
+    missing = [k for (k, v) in zip(keys, values) if v is None]
+    if missing:
+        fetched = dict(zip(missing, [v or b"0" for v in cachedb.mget(missing)]))
+        if l1cache.max_size:
+            for (k, v) in fetched.items():
+                l1cache.set(k, v)
+        values = [fetched[k] if v is None else v for (k, v) in zip(keys, values)]
+    return [int(v) for v in values]
+
+
+def cache_load(key):
+    """
+    Returns the `(fresh_until, delta, value)` entry cached under `key`,
+    `delta` being the seconds it took to compute, or None.
+    """
+    return unpack_entry(cache_get(key))
+
+
+def unpack_entry(packed):
+    return msgpack.unpackb(packed, raw=False) if packed else None
+
+
+def cache_fill(call, key, ttl, stale, evict_keys):
+    if ttl is None:
+        ttl = settings.cache_ttl
+    if ttl and settings.cache_ttl_jitter:
+        # so that keys filled together don't expire together
+        ttl *= 1 + random.uniform(0, settings.cache_ttl_jitter)
+
+    start = time.time()
+    resp = call()
+    now = time.time()
+    packed = msgpack.packb(
+        [now + ttl if ttl else None, now - start, resp], use_bin_type=True, default=json_default)
+    if settings.cache_max_size and len(packed) > settings.cache_max_size:
+        logger.debug("Not caching %s, %d bytes", key, len(packed))
+        return resp
+
+    expiry = int((ttl + stale) * 1000) if ttl else None
+    cachedb.set(key, packed, px=expiry)
+    if l1cache.max_size:
+        l1cache.set(key, packed)
+
+    for evict_key in format_keys(evict_keys, call):
+        name = f"catalog:eviction:{evict_key}"
+        # the set lives as long as the longest lived key it holds,
+        # -2 is a new set and -1 one holding keys that never expire
+        remaining = cachedb.pttl(name)
+        cachedb.Set(name).add(key)
+        if expiry is None:
+            cachedb.persist(name)
+        elif remaining == -2 or 0 <= remaining < expiry:
+            cachedb.pexpire(name, expiry)
+    return resp
+
+
+def is_fresh(fresh_until, delta, early_refresh=0):
+    if fresh_until is None:
+        return True
+    now = time.time()
+    if early_refresh:
+        # refresh before expiring, more likely as the expiry gets closer and
+        # for slower values (probabilistic early expiration, "XFetch")
+        now -= delta * early_refresh * math.log(1.0 - random.random())
+    return now < fresh_until
+
+
+@fn.decorator
+def cache(call, *, key=None, evict_keys=None, namespaces=None, ttl=None, stale=0, early_refresh=0):
+    """
+    Caches the endpoint result. Values expire after `ttl` seconds
+    (`CACHE_TTL` by default, 0 never expires) plus some jitter, and are
+    still served for `stale` seconds after while one request refreshes
+    them. `early_refresh` (1.0 is a good start) lets a request refresh a
+    value before it expires. Results over `CACHE_MAX_SIZE` aren't cached.
+    Values are invalidated either with `evict` on their `evict_keys`,
+    which deletes them, or with `invalidate` on their `namespaces`, which
+    leaves them to expire.
+    """
+    key = key if is_str(key) else key(call) if callable(key) else default_key(call)
+    # v2 entries are [fresh_until, delta, value], the prefix keeps values
+    # cached in the older raw format from being read as entries
+    key = f"catalog:cache:v2:{key}"
+    namespaces = format_keys(namespaces, call)
+    if namespaces:
+        # invalidating a namespace bumps its generation, so the keys
+        # cached under the previous one are never read again
+        key += "@" + ".".join(map(str, namespace_generations(namespaces)))
+    entry = cache_load(key)
+    if entry is not None:
+        (fresh_until, delta, resp) = entry
+        if is_fresh(fresh_until, delta, early_refresh):
+            return resp
+        if fresh_until + stale > time.time():
+            # serve the value unless this request gets to refresh it
+            lock = cachedb.lock(key, ttl=settings.cache_lock_duration)
+            if not lock.acquire(block=False):
+                return resp
+            try:
+                return cache_fill(call, key, ttl, stale, evict_keys)
+            finally:
+                lock.release()
 
     lock = cachedb.lock(key, ttl=settings.cache_lock_duration)
     with lock:
-        resp = call()
-        cachedb[key] = msgpack.packb(resp, use_bin_type=True)
-        evict_keys = (
-            evict_keys
-            if fn.is_list(evict_keys)
-            else [evict_keys]
-            if is_str(evict_keys)
-            else evict_keys(call)
-            if callable(evict_keys)
-            else []
-        )
-        evict_keys = [ek.format(**call._kwargs) for ek in evict_keys]
-        for evict_key in evict_keys:
-            cache_set = cachedb.Set(f"catalog:eviction:{evict_key}")
-            cache_set.add(key)
+        # another request may have filled it while waiting for the lock
+        entry = unpack_entry(cachedb.get(key))
+        if entry is not None and is_fresh(entry[0], entry[1]):
+            return entry[2]
+        return cache_fill(call, key, ttl, stale, evict_keys)
 
-    return resp
+
+# deletes the keys of an eviction set and the set itself, in batches
+# small enough for unpack(), returning the deleted keys
+evict_script = """
+local keys = redis.call("SMEMBERS", KEYS[1])
+for i = 1, #keys, 1000 do
+    redis.call("UNLINK", unpack(keys, i, math.min(i + 999, #keys)))
+end
+redis.call("UNLINK", KEYS[1])
+return keys
+"""
 
 
 @fn.decorator
 def evict(call, *evict_keys):
+    """
+    Deletes the values cached with any of `evict_keys`, with a single
+    round trip to redis. UNLINK frees their memory in the background.
+    """
     resp = call()
+    if not evict_keys:
+        return resp
+    script = cachedb.register_script(evict_script)
+    pipe = cachedb.pipeline()
     for evict_key in evict_keys:
         evict_key = evict_key(call) if callable(evict_key) else evict_key
         evict_key = evict_key.format(**call._kwargs)
-        cache_set = cachedb.Set(f"catalog:eviction:{evict_key}")
-        for key in cache_set.members():
-            cachedb.delete(key)
-        cache_set.clear()
+        script(keys=[f"catalog:eviction:{evict_key}"], client=pipe)
+    keys = [
+        k.decode("utf8") if isinstance(k, bytes) else k
+        for deleted in pipe.execute()
+        for k in deleted
+    ]
+    for key in keys:
+        l1cache.delete(key)
+    if keys and l1cache.max_size:
+        cachedb.publish(settings.cache_l1_channel, msgpack.packb(keys, use_bin_type=True))
+    return resp
+
+
+@fn.decorator
+def invalidate(call, *namespaces):
+    """
+    Invalidates every value cached under `namespaces` in constant time,
+    by bumping their generations.
+    """
+    resp = call()
+    keys = [
+        generation_key((ns(call) if callable(ns) else ns).format(**call._kwargs))
+        for ns in namespaces
+    ]
+    pipe = cachedb.pipeline()
+    for key in keys:
+        pipe.incr(key)
+    pipe.execute()
+    for key in keys:
+        l1cache.delete(key)
+    if keys and l1cache.max_size:
+        cachedb.publish(settings.cache_l1_channel, msgpack.packb(keys, use_bin_type=True))
     return resp
@@ -0,0 +1,88 @@
+import zlib
+from webob.dec import wsgify
+
+from .appconfig import appconfig
+from .settings import settings
+
+__all__ = ("compression_middleware",)
+
+
+@appconfig.settings()
+def compression_settings(**opts):
+    return {
+        "compression_level": appconfig.env.int("COMPRESSION_LEVEL", 6),
+        "compression_min_size": appconfig.env.int("COMPRESSION_MIN_SIZE", 1024),  # in bytes
+        "compression_content_types": appconfig.env.list("COMPRESSION_CONTENT_TYPES", [
+            "application/json",
+            "application/x-ndjson",
+            "application/javascript",
+            "text/html",
+            "text/css",
+            "text/plain",
+        ]),
+    }
+
+
+def gzip_compress(body, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor.compress(body) + compressor.flush()
+
+
+def gzip_app_iter(app_iter, level):
+    # flush after every chunk so streamed responses keep flowing
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    try:
+        for chunk in app_iter:
+            data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            if data:
+                yield data
+        yield compressor.flush()
+    finally:
+        if hasattr(app_iter, "close"):
+            app_iter.close()
+
+
+@wsgify.middleware
+def compression_middleware(req, app, level=6, min_size=1024, content_types=("application/json",)):
+    resp = req.get_response(app)
+
+    if (
+        "Accept-Encoding" not in req.headers
+        or not req.accept_encoding.acceptable_offers(["gzip"])
+        or req.method == "HEAD"
+        or resp.status_code < 200
+        or resp.status_code in (204, 206, 304)
+        # ranges are of the uncompressed body
+        or "Content-Range" in resp.headers
+        or resp.cache_control.no_transform
+        or resp.content_encoding
+        or resp.content_type not in content_types
+        or (resp.content_length is not None and resp.content_length < min_size)
+    ):
+        return resp
+
+    if resp.content_length is not None:
+        resp.body = gzip_compress(resp.body, level)
+    else:
+        resp.app_iter = gzip_app_iter(resp.app_iter, level)
+        resp.content_length = None
+
+    resp.content_encoding = "gzip"
+    resp.vary = tuple(resp.vary or ()) + ("Accept-Encoding",)
+    # the compressed body is a different representation of the resource
+    etag = resp.headers.get("ETag")
+    if etag and not etag.startswith("W/"):
+        resp.headers["ETag"] = "W/" + etag
+    return resp
+
+
+@appconfig.wsgi_middleware()
+def add_compression_middleware(application, **opts):
+    if opts.get("compression_middleware", True) == True:
+        application = compression_middleware(
+            application,
+            level=settings.compression_level,
+            min_size=settings.compression_min_size,
+            content_types=settings.compression_content_types,
+        )
+    return application
@@ -7,6 +7,8 @@ import funcy as fn
 
 from webob.dec import wsgify
 
+import pibe
+
 try:
     import peewee as pw
     from playhouse.signals import Model as SignalModel
@@ -111,15 +113,28 @@ def synchronize_database(drop_tables=None):
     database.create_tables(db_models(), safe=True)
 
 
+stream_content_types = tuple([content_type for (content_type, _) in pibe.stream_formats.values()])
+
+
+def close_database():
+    if not database.is_closed():
+        database.close()
+
+
 @wsgify.middleware
 def database_middleware(req, app):
     database.connect(reuse_if_open=True)
     try:
         resp = req.get_response(app)
-    finally:
-        if not database.is_closed():
-            database.close()
-    return resp
+    except:
+        close_database()
+        raise
+    # streamed JSON bodies run their queries while they're sent and keep
+    # the connection until then, other bodies (files, event streams) don't
+    if isinstance(resp.app_iter, (list, tuple)) or resp.content_type not in stream_content_types:
+        close_database()
+        return resp
+    return pibe.after_stream(resp, close_database)
 
 
 @appconfig.wsgi_middleware()
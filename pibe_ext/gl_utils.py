@@ -2,7 +2,7 @@ import gevent
 import logging
 from funcy import wraps
 
-__all__ = ('greenlet', 'infinite_loop', 'main_loop')
+__all__ = ('greenlet', 'infinite_loop', 'main_loop', 'request_locals', 'spawn_with_locals')
 
 logger = logging.getLogger(__name__)
 
@@ -40,6 +40,25 @@ def greenlet(**kwargs):
     return inner_wrapper
 
 
+# the gevent locals holding the request state (g, the serializers),
+# carried into the greenlets spawned on behalf of a request
+request_locals = []
+
+
+def spawn_with_locals(func, *args, **kwargs):
+    """
+    Spawns `func` in a greenlet seeing the `request_locals` values of the
+    current greenlet.
+    """
+    values = [(l, dict(l.__dict__)) for l in request_locals]
+
+    def run():
+        for (l, state) in values:
+            l.__dict__.update(state)
+        return func(*args, **kwargs)
+    return gevent.spawn(run)
+
+
 @greenlet()
 def infinite_loop():
     while 1:
@@ -4,11 +4,13 @@ import decimal
 import types
 import funcy as fn
 import json
+import msgpack
 from webob import Response, exc
 
 import pibe
 from pibe import JSONRouter
 
+from .appconfig import appconfig
 from .settings import settings
 
 logger = logging.getLogger(__name__)
@@ -23,7 +25,11 @@ __all__ = (
     "unprocessable_entity",
     "expectation_failed",
     "bad_gateway",
+    "payload_too_large",
+    "service_unavailable",
     "is_json",
+    "read_body",
+    "request_data",
     "no_content",
     "created",
 )
@@ -33,6 +39,19 @@ http = JSONRouter()
 pibe.regex_fn["shortuuid"] = r"[2-9A-HJ-NP-Za-km-z]{22}"
 
 
+@appconfig.settings()
+def http_settings(**opts):
+    return {
+        "max_body_size": appconfig.env.int("HTTP_MAX_BODY_SIZE", 10 * 1024 * 1024),  # in bytes, 0 disables
+    }
+
+
+@appconfig.finalize()
+def freeze_http_router(**opts):
+    if opts.get("freeze_router", True) == True:
+        http.freeze()
+
+
 def _raise_exc(
     exc_class,
     _default_error="Unknown Error Description",
@@ -78,12 +97,72 @@ def bad_gateway(**kwargs):
     _raise_exc(exc.HTTPBadGateway, _default_error="Bad Gateway", **kwargs)
 
 
+def payload_too_large(**kwargs):
+    _raise_exc(exc.HTTPRequestEntityTooLarge, _default_error="Payload Too Large", **kwargs)
+
+
+def service_unavailable(**kwargs):
+    _raise_exc(exc.HTTPServiceUnavailable, _default_error="Service Unavailable", **kwargs)
+
+
+
+def read_body(req, max_size=None, chunk_size=64 * 1024):
+    """
+    Yields the request body in chunks. Bodies declaring a length over
+    `max_size` (defaults to the `max_body_size` setting) are rejected with
+    a 413 before reading, others as soon as they grow past it.
+    """
+    max_size = settings.get("max_body_size", 0) if max_size is None else max_size
+    if max_size and (req.content_length or 0) > max_size:
+        payload_too_large()
+
+    body_file = req.body_file
+    size = 0
+    while True:
+        chunk = body_file.read(chunk_size)
+        if not chunk:
+            break
+        size += len(chunk)
+        if max_size and size > max_size:
+            payload_too_large()
+        yield chunk
+
+
+def _decode_body(req):
+    # the body stays available to req.body and req.json
+    req.body = b"".join(read_body(req))
+    if req.content_type in pibe.msgpack_content_types:
+        try:
+            return msgpack.unpackb(req.body, raw=False)
+        except Exception as e:
+            raise ValueError("Invalid msgpack body") from e
+    return json.loads(req.body)
+
+
+def request_data(req):
+    """
+    Decodes the request body, as msgpack when the request content type
+    says so and as JSON otherwise. Raises a ValueError on invalid bodies.
+    The body is read and decoded once per request, later calls return
+    the same data (or raise the same error).
+    """
+    if "pibe_ext.request_data" not in req.environ:
+        try:
+            req.environ["pibe_ext.request_data"] = (_decode_body(req), None)
+        except (ValueError, exc.HTTPRequestEntityTooLarge) as e:
+            req.environ["pibe_ext.request_data"] = (None, e)
+
+    (data, error) = req.environ["pibe_ext.request_data"]
+    if error is not None:
+        raise error
+    return data
+
 
 @fn.decorator
 def is_json(call):
     try:
-        call.req.json
-    except:
+        request_data(call.req)
+    except ValueError:
         not_acceptable(error="Invalid JSON request")
     return call()
 
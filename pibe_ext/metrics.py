@@ -0,0 +1,29 @@
+from webob import Response
+from pibe import RouteTimings
+
+from .appconfig import appconfig
+from .settings import settings
+from .http import http, not_found
+
+__all__ = ("metrics_endpoint",)
+
+
+@appconfig.settings()
+def metrics_settings(**opts):
+    return {
+        "metrics_enabled": appconfig.env.bool("METRICS_ENABLED", False),
+        "metrics_sample_rate": appconfig.env.float("METRICS_SAMPLE_RATE", 0.1),
+    }
+
+
+@appconfig.initialize()
+def initialize_metrics(**opts):
+    if settings.metrics_enabled:
+        http.timings = RouteTimings(sample_rate=settings.metrics_sample_rate)
+
+
+@http.get("/_metrics", hooks=False, shared_opts=True)
+def metrics_endpoint(req):
+    if not http.timings:
+        not_found()
+    return Response(http.timings.prometheus(), content_type="text/plain", charset="utf-8")
@@ -4,12 +4,11 @@ import playhouse.postgres_ext as pw_pext
 
 import funcy as fn
 from webob import exc
-from json.decoder import JSONDecodeError
 import cerberus
 from pibe import DotDict
 import arrow
 
-from .http import _raise_exc, not_acceptable
+from .http import _raise_exc, not_acceptable, request_data
 
 __all__ = (
     "model_schema",
@@ -109,8 +108,8 @@ def model_validate(model_class,
         @fn.wraps(func)
         def wrapper(req, *args, **kwargs):
             try:
-                data = dict(req.json)
-            except JSONDecodeError:
+                data = dict(request_data(req))
+            except ValueError:
                 not_acceptable(error="Invalid JSON Request")
 
             v = cerberus.Validator(_schema, **kwargs)
@@ -1,6 +1,6 @@
 import logging
 from pibe_ext.validator import *
-from pibe_ext.http import http, no_content
+from pibe_ext.http import http, no_content, request_data
 
 logger = logging.getLogger(__name__)
 
@@ -59,8 +59,8 @@ rpc = RPCRegistry()
 @http.post("/rpc")
 def process_rpc(req):
     try:
-        payload = req.json
-    except:
+        payload = request_data(req)
+    except ValueError:
         return {
             "jsonrpc": "2.0",
             "error": {"code": -32700, "message": "Parse error"}
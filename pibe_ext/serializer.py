@@ -3,9 +3,11 @@ import peewee as pw
 from gevent.local import local
 
 from .http import http
+from .gl_utils import request_locals
 
 
 session_serializers = local()
+request_locals.append(session_serializers)
 
 __all__ = (
     "set_serializer",
@@ -51,17 +53,14 @@ def model_serializer(
         else:
             field = None
 
+        # dates, datetimes and decimals are left to the response json encoder
         if field and getattr(obj, field_name) is not None:
-            if field.__class__ in (pw.DateField, pw.DateTimeField):
-                return getattr(obj, field_name).isoformat()
-            elif field.__class__ == pw.ForeignKeyField:
+            if field.__class__ == pw.ForeignKeyField:
                 serializer_fn = get_serializer(field.rel_model, follow_m2m=False)
                 return serializer_fn(getattr(obj, field_name))
             elif field.__class__ == pw.ManyToManyField:
                 serializer_fn = get_serializer(field.rel_model, follow_m2m=False)
                 return [serializer_fn(item) for item in getattr(obj, field_name)]
-            elif field.__class__ == pw.DecimalField:
-                return str(getattr(obj, field_name))
 
         return getattr(obj, field_name)
 
@@ -1,9 +1,11 @@
 from gevent.local import local
 from .http import http
+from .gl_utils import request_locals
 
 __all__ = ("g", )
 
 g = local()
+request_locals.append(g)
 
 
 @http.before_request()
@@ -0,0 +1,127 @@
+import logging
+import collections
+import funcy as fn
+import gevent
+from gevent.queue import Queue, Empty
+from webob import Response
+
+import pibe
+
+from .appconfig import appconfig
+from .settings import settings
+from .http import service_unavailable
+from .gl_utils import spawn_with_locals
+
+__all__ = ("Event", "format_event", "EventStream", "event_stream")
+
+logger = logging.getLogger(__name__)
+
+# an event with a name, id or retry delay, plain values are sent as data
+Event = collections.namedtuple("Event", ("data", "event", "id", "retry"), defaults=(None, None, None))
+
+
+@appconfig.settings()
+def sse_settings(**opts):
+    return {
+        "sse_heartbeat": appconfig.env.float("SSE_HEARTBEAT", 15.0),  # in seconds
+        "sse_max_connections": appconfig.env.int("SSE_MAX_CONNECTIONS", 5000),  # per process
+        "sse_queue_size": appconfig.env.int("SSE_QUEUE_SIZE", 100),
+    }
+
+
+def format_event(event, encoder=pibe.json_encoder):
+    if not isinstance(event, Event):
+        event = Event(event)
+    lines = []
+    if event.event is not None:
+        lines.append(b"event: " + str(event.event).encode("utf8"))
+    if event.id is not None:
+        lines.append(b"id: " + str(event.id).encode("utf8"))
+    if event.retry is not None:
+        lines.append(b"retry: " + str(int(event.retry)).encode("utf8"))
+    if event.data is not None:
+        data = event.data
+        if isinstance(data, str):
+            data = data.encode("utf8")
+        elif not isinstance(data, bytes):
+            data = encoder(data)
+        lines.extend([b"data: " + line for line in data.split(b"\n")])
+    return b"\n".join(lines) + b"\n\n"
+
+
+class EventStream(object):
+    """
+    The `app_iter` of a text/event-stream response. The events are produced
+    in their own greenlet, which sees the request locals, so waiting for the
+    next one never blocks the worker, and a comment is sent every
+    `heartbeat` seconds without events.
+    The server closes it when the client goes away, which kills the producer.
+    """
+    active = 0
+
+    def __init__(self, events, heartbeat, queue_size=100):
+        self.heartbeat = heartbeat
+        self.queue = Queue(maxsize=queue_size)
+        self.closed = False
+        EventStream.active += 1
+        self.greenlet = spawn_with_locals(self.produce, events)
+
+    def produce(self, events):
+        try:
+            for event in events:
+                self.queue.put(format_event(event))
+        except gevent.GreenletExit:
+            raise
+        except Exception:
+            logger.exception("Event stream failed")
+        finally:
+            if hasattr(events, "close"):
+                events.close()
+        self.queue.put(StopIteration)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.closed:
+            raise StopIteration
+        try:
+            item = self.queue.get(timeout=self.heartbeat)
+        except Empty:
+            return b": heartbeat\n\n"
+        if item is StopIteration:
+            self.close()
+            raise StopIteration
+        return item
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            EventStream.active -= 1
+            self.greenlet.kill(block=False)
+
+
+@fn.decorator
+def event_stream(call):
+    """
+    Streams the events yielded by the endpoint as Server-Sent Events.
+    The route opts `sse_heartbeat` and `sse_queue_size` override the settings.
+    """
+    opts = getattr(call.req, "opts", None) or {}
+    resp = Response(content_type="text/event-stream", charset="utf-8")
+    resp.cache_control = "no-cache"
+    resp.headers["X-Accel-Buffering"] = "no"
+    if call.req.method == "HEAD":
+        resp.content_length = None
+        return resp
+
+    max_connections = settings.get("sse_max_connections", 5000)
+    if max_connections and EventStream.active >= max_connections:
+        service_unavailable(error="Too many event streams")
+
+    resp.app_iter = EventStream(
+        call(),
+        opts.get("sse_heartbeat") or settings.get("sse_heartbeat", 15.0),
+        opts.get("sse_queue_size") or settings.get("sse_queue_size", 100),
+    )
+    return resp
@@ -1,11 +1,10 @@
 import funcy as fn
 from webob import exc
-from json.decoder import JSONDecodeError
 import cerberus
 from pibe import DotDict
 
 
-from .http import _raise_exc, not_acceptable
+from .http import _raise_exc, not_acceptable, request_data
 
 __all__ = ("validate", )
 
@@ -20,8 +19,8 @@ def validate(
 
     if data_source == "json_body":
         try:
-            data = dict(call.req.json)
-        except JSONDecodeError:
+            data = dict(request_data(call.req))
+        except ValueError:
             not_acceptable(error="Invalid JSON Request")
 
     elif data_source == "params":
@@ -4,6 +4,10 @@ from unittest.mock import MagicMock
 class FunctionMagicMock(MagicMock):
     __name__ = "name"
 
+def assert_called(mock):
+    assert mock.called
+
+
 def test_appconfig():
     ac = AppConfig()
 
@@ -16,11 +20,16 @@ def test_appconfig():
     sf3 = FunctionMagicMock()
     ac.wsgi_middleware.append(sf3)
 
+    # runs after the initialize callbacks
+    sf4 = FunctionMagicMock(side_effect=lambda **opts: assert_called(sf2))
+    ac.finalize.append(sf4)
+
     ac.start_app(MagicMock())
 
     assert sf1.called
     assert sf2.called
     assert sf3.called
+    assert sf4.called
     # sf.reset_mock()
     #
     # assert sf.called
@@ -0,0 +1,372 @@
+import time
+import types
+import msgpack
+import pytest
+import walrus
+from unittest.mock import patch
+from webob import Request
+import pibe_ext.cache as cache_module
+from pibe_ext.cache import L1Cache, cache, evict, invalidate, cache_stats
+
+
+class FakeSet(object):
+    def __init__(self, db, name):
+        self.db = db
+        self.name = name
+
+    def add(self, *values):
+        self.db.sets.setdefault(self.name, set()).update(v.encode() for v in values)
+
+    def members(self):
+        return set(self.db.sets.get(self.name, ()))
+
+    def clear(self):
+        self.db.sets.pop(self.name, None)
+
+
+class FakeLock(object):
+    def __init__(self, db, key):
+        self.db = db
+        self.key = key
+
+    def acquire(self, block=True):
+        if self.key in self.db.locks:
+            assert not block, "would wait forever"
+            return False
+        (on_lock, self.db.on_lock) = (self.db.on_lock, None)
+        if on_lock:
+            on_lock(self.key)
+        self.db.locks.add(self.key)
+        return True
+
+    def release(self):
+        self.db.locks.discard(self.key)
+
+    def __enter__(self):
+        self.acquire()
+
+    def __exit__(self, *args):
+        self.release()
+
+
+class FakePipeline(object):
+    def __init__(self, db):
+        self.db = db
+        self.calls = []
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self.calls.append((name, args, kwargs))
+
+    def execute(self):
+        return [getattr(self.db, name)(*args, **kwargs) for (name, args, kwargs) in self.calls]
+
+
+class FakeDB(object):
+    """the walrus calls used by pibe_ext.cache, in memory"""
+
+    def __init__(self):
+        self.data = {}
+        self.expiry = {}
+        self.sets = {}
+        self.locks = set()
+        self.on_lock = None
+        self.published = []
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def delete(self, key):
+        self.data.pop(key.decode() if isinstance(key, bytes) else key, None)
+
+    def set(self, key, value, px=None):
+        self.data[key] = value
+        self.expiry[key] = px
+
+    def mget(self, keys):
+        return [self.data.get(k) for k in keys]
+
+    def incr(self, key):
+        self.data[key] = str(int(self.data.get(key, 0)) + 1).encode()
+
+    def register_script(self, script):
+        def run(keys=(), args=(), client=None):
+            (client or self).calls.append(("evict_set", tuple(keys), {}))
+        return run
+
+    def evict_set(self, name):
+        keys = self.sets.pop(name, set())
+        for key in keys:
+            self.data.pop(key.decode(), None)
+        return list(keys)
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+    def pttl(self, key):
+        if key not in self.data and key not in self.sets:
+            return -2
+        return self.expiry.get(key) or -1
+
+    def pexpire(self, key, px):
+        self.expiry[key] = px
+
+    def persist(self, key):
+        self.expiry.pop(key, None)
+
+    def lock(self, key, ttl=None):
+        return FakeLock(self, key)
+
+    def Set(self, name):
+        return FakeSet(self, name)
+
+    def publish(self, channel, message):
+        self.published.append((channel, msgpack.unpackb(message, raw=False)))
+
+
+@pytest.fixture
+def cachedb():
+    db = FakeDB()
+    l1 = L1Cache(max_size=1024, ttl=60)
+    settings = {
+        "cache_lock_duration": 500,
+        "cache_l1_channel": "evictions",
+        "cache_ttl": 3600,
+        "cache_ttl_jitter": 0,
+        "cache_max_size": 1024,
+    }
+    with patch.object(cache_module, "cachedb", db), \
+            patch.object(cache_module, "l1cache", l1), \
+            patch.dict(cache_module.l2_stats, hits=0, misses=0), \
+            patch.dict(cache_module.settings, settings):
+        yield db
+
+
+def test_l1_cache():
+    l1 = L1Cache(max_size=20, ttl=60)
+    l1.set("a", b"x" * 9)
+    l1.set("b", b"x" * 9)
+    assert l1.get("a") == b"x" * 9
+    l1.set("c", b"x" * 9)
+    # "b" was the least recently used
+    assert l1.get("b") is None
+    assert l1.size == 20
+
+    l1.set("d", b"x" * 100)
+    assert l1.get("d") is None
+
+    l1.ttl = -1
+    l1.set("e", b"x")
+    assert l1.get("e") is None
+    assert l1.stats()["hits"] == 1
+
+
+def endpoint_key(foo_id, query=""):
+    call = types.SimpleNamespace(
+        _func=types.SimpleNamespace(__name__="endpoint"),
+        _args=(Request.blank("/" + query),),
+        _kwargs={"foo_id": foo_id},
+    )
+    return "catalog:cache:v2:" + cache_module.default_key(call)
+
+
+def make_endpoint(**opts):
+    calls = []
+
+    @cache(evict_keys="foo:{foo_id}", **opts)
+    def endpoint(req, foo_id):
+        calls.append(foo_id)
+        return {"foo": "bar"}
+    return (endpoint, calls)
+
+
+def test_cache_tiers(cachedb):
+    (cached, calls) = make_endpoint()
+    req = Request.blank("/")
+
+    assert cached(req, foo_id=1) == {"foo": "bar"}
+    # served from the L1 without asking redis
+    cachedb.data.clear()
+    assert cached(req, foo_id=1) == {"foo": "bar"}
+    assert calls == [1]
+
+    assert cached(req, foo_id=2) == {"foo": "bar"}
+    cache_module.l1cache.clear()
+    assert cached(req, foo_id=2) == {"foo": "bar"}
+    assert calls == [1, 2]
+
+    stats = cache_stats()
+    assert (stats["l1"]["hits"], stats["l1"]["misses"]) == (1, 3)
+    assert stats["l2"] == {"hits": 1, "misses": 2, "hit_ratio": 1 / 3}
+
+
+def test_evict_broadcast(cachedb):
+    (cached, calls) = make_endpoint()
+
+    @evict("foo:{foo_id}")
+    def update(req, foo_id):
+        pass
+
+    req = Request.blank("/")
+
+    cached(req, foo_id=1)
+    cached(req, foo_id=1)
+    update(req, foo_id=1)
+    assert cachedb.published == [("evictions", [endpoint_key(1)])]
+    assert cache_module.l1cache.get(endpoint_key(1)) is None
+
+    cached(req, foo_id=1)
+    assert calls == [1, 1]
+
+
+def test_cache_double_checked_locking(cachedb):
+    (cached, calls) = make_endpoint()
+    (other, other_calls) = make_endpoint()
+    req = Request.blank("/")
+
+    # another request fills the key while this one waits for the lock
+    cachedb.on_lock = lambda key: other(req, foo_id=1)
+    assert cached(req, foo_id=1) == {"foo": "bar"}
+    assert other_calls == [1]
+    assert calls == []
+
+
+def test_cache_stale_while_revalidate(cachedb):
+    (cached, calls) = make_endpoint(ttl=0.01, stale=60)
+    req = Request.blank("/")
+    key = endpoint_key(1)
+
+    cached(req, foo_id=1)
+    assert cachedb.expiry[key] == 60010
+    time.sleep(0.02)
+
+    # another request is refreshing it, the stale value is served
+    cachedb.locks.add(key)
+    assert cached(req, foo_id=1) == {"foo": "bar"}
+    assert calls == [1]
+
+    # this one refreshes it
+    cachedb.locks.clear()
+    assert cached(req, foo_id=1) == {"foo": "bar"}
+    assert calls == [1, 1]
+
+
+def test_cache_early_refresh():
+    fresh_until = time.time() + 10
+    assert cache_module.is_fresh(None, 1.0, 1.0)
+    assert cache_module.is_fresh(fresh_until, 1.0)
+    with patch.object(cache_module.random, "random", return_value=0.5):
+        assert cache_module.is_fresh(fresh_until, 1.0, 1.0)
+    # values taking a second to compute, 10s before they expire
+    with patch.object(cache_module.random, "random", return_value=1 - 1e-9):
+        assert not cache_module.is_fresh(fresh_until, 1.0, 1.0)
+        assert cache_module.is_fresh(fresh_until, 0.001, 1.0)
+
+
+def test_cache_expiry(cachedb):
+    (cached, calls) = make_endpoint()
+    req = Request.blank("/")
+    cached(req, foo_id=1)
+    assert cachedb.expiry[endpoint_key(1)] == 3600000
+    assert cachedb.expiry["catalog:eviction:foo:1"] == 3600000
+
+    (cached, calls) = make_endpoint(ttl=0)
+    cached(req, foo_id=2)
+    assert cachedb.expiry[endpoint_key(2)] is None
+    assert "catalog:eviction:foo:2" not in cachedb.expiry
+
+    with patch.dict(cache_module.settings, cache_ttl_jitter=0.1):
+        (cached, calls) = make_endpoint(ttl=100)
+        cached(req, foo_id=3)
+        assert 100000 <= cachedb.expiry[endpoint_key(3)] <= 110000
+
+
+def test_cache_max_size(cachedb):
+    calls = []
+
+    @cache(evict_keys="big")
+    def big(req):
+        calls.append(1)
+        return "x" * 2048
+
+    req = Request.blank("/")
+    big(req)
+    big(req)
+    assert calls == [1, 1]
+    assert cachedb.data == {}
+    assert cachedb.sets == {}
+
+
+def test_cache_namespaces(cachedb):
+    (cached, calls) = make_endpoint(namespaces=["foos", "foo:{foo_id}"])
+
+    @invalidate("foo:{foo_id}")
+    def update(req, foo_id):
+        pass
+
+    req = Request.blank("/")
+    cached(req, foo_id=1)
+    cached(req, foo_id=2)
+    cached(req, foo_id=1)
+    assert calls == [1, 2]
+    assert endpoint_key(1) + "@0.0" in cachedb.data
+
+    update(req, foo_id=1)
+    assert cachedb.published == [("evictions", ["catalog:generation:foo:1"])]
+    cached(req, foo_id=1)
+    cached(req, foo_id=2)
+    assert calls == [1, 2, 1]
+    assert endpoint_key(1) + "@0.1" in cachedb.data
+
+    # generations are served from the L1 until they're invalidated
+    cachedb.data["catalog:generation:foos"] = b"5"
+    cached(req, foo_id=2)
+    assert calls == [1, 2, 1]
+
+
+def test_default_key(cachedb):
+    (cached, calls) = make_endpoint()
+    cached(Request.blank("/?a=1&b=2"), foo_id=1)
+    cached(Request.blank("/?b=2&a=1"), foo_id=1)
+    cached(Request.blank("/?a=" + "x" * 10000), foo_id=1)
+    assert calls == [1, 1]
+    assert endpoint_key(1, "?a=1&b=2") in cachedb.data
+    assert len(set(map(len, cachedb.data))) == 1
+
+
+def test_evict_script():
+    # runs the lua script of evict against fakeredis
+    fakeredis = pytest.importorskip("fakeredis")
+    db = walrus.Database(connection_pool=fakeredis.FakeRedis().connection_pool)
+    keys = [f"catalog:cache:key{i}" for i in range(2500)]
+    db.mset(dict.fromkeys(keys, b"value"))
+    db.sadd("catalog:eviction:foo:1", *keys)
+    db.sadd("catalog:eviction:bar", keys[0], "catalog:cache:other")
+    db.set("catalog:cache:other", b"value")
+    db.set("catalog:cache:kept", b"value")
+
+    @evict("foo:{foo_id}", "bar")
+    def update(req, foo_id):
+        pass
+
+    with patch.object(cache_module, "cachedb", db), patch.object(cache_module, "l1cache", L1Cache()):
+        update(Request.blank("/"), foo_id=1)
+    assert db.keys() == [b"catalog:cache:kept"]
+
+
+def test_default_key_is_unambiguous(cachedb):
+    assert endpoint_key(1, "?a=1%26b%3D2") != endpoint_key(1, "?a=1&b=2")
+    assert endpoint_key(1, "?a=1&b=2") == endpoint_key(1, "?b=2&a=1")
+
+
+def test_cache_ignores_old_values(cachedb):
+    calls = []
+
+    @cache(key="colors")
+    def colors(req):
+        calls.append(1)
+        return ["red", "green", "blue"]
+
+    cachedb.data["catalog:cache:colors"] = msgpack.packb(["red", "green", "blue"])
+    assert colors(Request.blank("/")) == ["red", "green", "blue"]
+    assert colors(Request.blank("/")) == ["red", "green", "blue"]
+    assert calls == [1]
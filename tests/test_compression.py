@@ -0,0 +1,76 @@
+import gzip
+import pibe
+from webob import Request, Response
+from pibe_ext.compression import compression_middleware
+
+
+def make_app():
+    route = pibe.JSONRouter()
+
+    @route.get("/small/")
+    def small(req):
+        return {"foo": "bar"}
+
+    @route.get("/large/", etag=True)
+    def large(req):
+        return {"items": list(range(1000))}
+
+    @route.get("/stream/", stream_flush_size=100)
+    def stream(req):
+        return ({"id": i} for i in range(100))
+
+    @route.get("/raw/")
+    def raw(req):
+        resp = Response(json_body={"items": list(range(1000))})
+        resp.cache_control = "no-transform"
+        return resp
+
+    return compression_middleware(route.application, min_size=100, content_types=("application/json",))
+
+
+def get(app, path, **headers):
+    return Request.blank(path, headers=headers).get_response(app)
+
+
+def test_compression():
+    app = make_app()
+
+    resp = get(app, "/small/", **{"Accept-Encoding": "gzip"})
+    assert resp.content_encoding is None
+
+    resp = get(app, "/large/")
+    assert resp.content_encoding is None
+
+    resp = get(app, "/large/", **{"Accept-Encoding": "gzip"})
+    assert resp.content_encoding == "gzip"
+    assert "Accept-Encoding" in resp.vary
+    assert resp.headers["ETag"].startswith("W/")
+    assert resp.content_length == len(resp.body)
+    assert gzip.decompress(resp.body) == b'{"items":[%s]}' % ",".join(map(str, range(1000))).encode()
+
+    resp = get(app, "/stream/", **{"Accept-Encoding": "gzip"})
+    assert resp.content_encoding == "gzip"
+    assert resp.content_length is None
+    chunks = list(resp.app_iter)
+    assert len(chunks) > 1
+    assert gzip.decompress(b"".join(chunks)).startswith(b'[{"id":0},{"id":1}')
+
+
+def test_compression_conditional_get():
+    app = make_app()
+    etag = get(app, "/large/", **{"Accept-Encoding": "gzip"}).headers["ETag"]
+    resp = get(app, "/large/", **{"Accept-Encoding": "gzip", "If-None-Match": etag})
+    assert resp.status_code == 304
+
+
+def test_compression_skips_ranges_and_no_transform():
+    app = make_app()
+    body = get(app, "/large/").body
+    resp = get(app, "/large/", **{"Accept-Encoding": "gzip", "Range": "bytes=0-199"})
+    assert resp.status_code == 206
+    assert resp.content_encoding is None
+    assert resp.body == body[:200]
+
+    resp = get(app, "/raw/", **{"Accept-Encoding": "gzip"})
+    assert resp.content_encoding is None
+    assert resp.json == {"items": list(range(1000))}
@@ -0,0 +1,77 @@
+import io
+import msgpack
+import pytest
+from unittest.mock import patch
+from webob import Request, exc
+from webtest import TestApp
+
+import pibe
+from pibe_ext.http import request_data, is_json
+from pibe_ext.settings import settings
+from pibe_ext.validator import validate
+
+
+def test_request_data():
+    req = Request.blank("/", method="POST", body=b'{"foo": "bar"}', content_type="application/json")
+    assert request_data(req) == {"foo": "bar"}
+
+    req = Request.blank("/", method="POST", body=msgpack.packb({"foo": "bar"}),
+                        content_type="application/msgpack")
+    assert request_data(req) == {"foo": "bar"}
+
+    req = Request.blank("/", method="POST", body=b"\xc1", content_type="application/msgpack")
+    with pytest.raises(ValueError):
+        request_data(req)
+
+    req = Request.blank("/", method="POST", body=msgpack.packb({"foo": "bar"}) + b"\x01",
+                        content_type="application/msgpack")
+    with pytest.raises(ValueError):
+        request_data(req)
+    assert req.body == msgpack.packb({"foo": "bar"}) + b"\x01"
+
+
+def test_validate_msgpack():
+    route = pibe.JSONRouter()
+
+    @route.post("/")
+    @validate({"foo": {"type": "string"}})
+    def endpoint(req):
+        return dict(req.data)
+
+    app = TestApp(route.application)
+    resp = app.post("/", msgpack.packb({"foo": "bar"}), content_type="application/msgpack",
+                    headers={"Accept": "application/msgpack"})
+    assert msgpack.unpackb(resp.body) == {"foo": "bar"}
+
+    resp = app.post("/", b"{", content_type="application/json", expect_errors=True)
+    assert resp.status_code == 406
+
+
+def test_request_data_is_cached():
+    req = Request.blank("/", method="POST", body=b'{"foo": "bar"}', content_type="application/json")
+    data = request_data(req)
+    assert request_data(req) is data
+    assert req.json == {"foo": "bar"}
+
+
+def test_max_body_size():
+    route = pibe.JSONRouter()
+
+    @route.post("/")
+    @is_json
+    def endpoint(req):
+        return request_data(req)
+
+    app = TestApp(route.application)
+    with patch.dict(settings, max_body_size=10):
+        assert app.post("/", b'{"a": 1}', content_type="application/json").json == {"a": 1}
+        resp = app.post("/", b'{"a": 12345}', content_type="application/json", expect_errors=True)
+        assert resp.status_code == 413
+
+        # without a content length the body is rejected while it is read
+        req = Request.blank("/", method="POST", content_type="application/json")
+        req.body_file = io.BytesIO(b'{"a": 12345}')
+        req.environ.pop("CONTENT_LENGTH", None)
+        req.environ["HTTP_TRANSFER_ENCODING"] = "chunked"
+        with pytest.raises(exc.HTTPRequestEntityTooLarge):
+            request_data(req)
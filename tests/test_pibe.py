@@ -1,3 +1,10 @@
+import json
+import uuid
+import decimal
+import datetime
+import asyncio
+import threading
+import warnings
 import pytest
 from webtest import TestApp
 from unittest.mock import MagicMock
@@ -202,6 +209,51 @@ def test_named_routes():
     route.get("/fooz-baaz/<baaz_id>/dummy/", name="fooz-baaz")(MagicMock(return_value=Response()))
     assert route.reverse("fooz-baaz", baaz_id=1) == "/fooz-baaz/1/dummy/"
 
+    assert route.reverse("dummy") == "#unknown"
+    assert route.reverse("baaz", 11, 22) == "/baaz/11/fooz/22/"
+
+
+def test_reverse_checks_arguments():
+    route = pibe.Router()
+    route.get("/foo/<foo_id:int>/", name="foo")(MagicMock(return_value=Response()))
+
+    with pytest.raises(ValueError):
+        route.reverse("foo", foo_id="bar")
+    with pytest.raises(KeyError):
+        route.reverse("foo")
+
+    assert route.reverse_many("foo", [{"foo_id": 1}, {"foo_id": 2}]) == ["/foo/1/", "/foo/2/"]
+    assert route.reverse_many("dummy", [{}]) == ["#unknown"]
+
+
+def test_reverse_escapes():
+    route = pibe.Router()
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        route.get(r"/a/<value:re(\d+)>/", name="a")(MagicMock(return_value=Response()))
+        route.get("/b/\\'%<value:int>/", name="b")(MagicMock(return_value=Response()))
+
+    assert route.reverse("a", value="12") == "/a/12/"
+    assert route.reverse("b", value=3) == "/b/\\'%3/"
+    with pytest.raises(ValueError, match=r"for value in /a/<value:re\(\\d\+\)>/"):
+        route.reverse("a", value="x")
+
+
+def test_typed_converters():
+    route = pibe.Router(typed_converters=True)
+
+    resource_mock = MagicMock(return_value=Response())
+    route.get("/foo/<foo_id:int>/<day:day>/<ref:uuid>/<label>/", name="foo")(resource_mock)
+
+    app = TestApp(route.application)
+    ref = "0b7e3bb4-7f2c-4b3a-9d7b-2b53b1e5d6f1"
+    assert app.get(f"/foo/12/03/{ref}/bar/").status_code == 200
+    assert resource_mock.call_args[1] == {
+        "foo_id": 12, "day": 3, "ref": uuid.UUID(ref), "label": "bar"}
+
+    assert route.reverse("foo", foo_id=12, day=3, ref=uuid.UUID(ref), label="bar") == f"/foo/12/03/{ref}/bar/"
+    assert route.reverse("foo", foo_id="12", day="03", ref=ref, label="bar") == f"/foo/12/03/{ref}/bar/"
+
 
 def test_json_router():
     route = pibe.JSONRouter()
@@ -215,6 +267,202 @@ def test_json_router():
     assert resp.json == {"foo": "bar"}
 
 
+@pytest.mark.parametrize("encoder", [
+    pibe.stdlib_json_encoder,
+    pytest.param(pibe.orjson_encoder,
+                 marks=pytest.mark.skipif(pibe.orjson is None, reason="orjson not installed")),
+])
+def test_json_encoder(encoder):
+    route = pibe.JSONRouter(json_encoder=encoder)
+    payload = {
+        "date": datetime.date(2020, 1, 2),
+        "datetime": datetime.datetime(2020, 1, 2, 3, 4, 5),
+        "decimal": decimal.Decimal("1.10"),
+        "uuid": uuid.UUID("0b7e3bb4-7f2c-4b3a-9d7b-2b53b1e5d6f1"),
+    }
+    route.get("/")(MagicMock(return_value=payload))
+    route.get("/custom/", json_encoder=lambda resp: b"custom")(MagicMock(return_value=payload))
+
+    app = TestApp(route.application)
+    resp = app.get("/")
+    assert resp.content_type == "application/json"
+    assert resp.body == (b'{"date":"2020-01-02","datetime":"2020-01-02T03:04:05",'
+                         b'"decimal":"1.10","uuid":"0b7e3bb4-7f2c-4b3a-9d7b-2b53b1e5d6f1"}')
+    assert app.get("/custom/").body == b"custom"
+
+
+def test_json_streaming():
+    route = pibe.JSONRouter()
+
+    @route.get("/items/")
+    def items(req):
+        return ({"id": i} for i in range(3))
+
+    @route.get("/items.ndjson", stream_format="ndjson", stream_flush_size=1)
+    def items_ndjson(req):
+        return iter([{"id": i} for i in range(3)])
+
+    @route.get("/empty/")
+    def empty(req):
+        return iter([])
+
+    app = TestApp(route.application)
+    resp = app.get("/items/")
+    assert resp.content_type == "application/json"
+    assert resp.json == [{"id": 0}, {"id": 1}, {"id": 2}]
+    assert app.get("/empty/").json == []
+
+    resp = app.get("/items.ndjson")
+    assert resp.content_type == "application/x-ndjson"
+    assert resp.body == b'{"id":0}\n{"id":1}\n{"id":2}\n'
+
+    (func, kwargs, opts) = route.resolve(Request.blank("/items.ndjson"))
+    resp = route.response_wrapper(func(None), **opts)
+    assert list(resp.app_iter) == [b'{"id":0}\n', b'{"id":1}\n', b'{"id":2}\n']
+
+
+def test_streaming_after_request():
+    route = pibe.JSONRouter()
+    session = {}
+
+    @route.before_request()
+    def open_session(req):
+        session["open"] = True
+
+    @route.after_request()
+    def close_session(req):
+        session["open"] = False
+
+    @route.get("/items/")
+    def items(req):
+        return ({"id": i, "open": session["open"]} for i in range(2))
+
+    app = TestApp(route.application)
+    assert app.get("/items/").json == [{"id": 0, "open": True}, {"id": 1, "open": True}]
+    assert session["open"] is False
+
+    route.timings = pibe.RouteTimings(sample_rate=1.0)
+    assert app.get("/items/").json == [{"id": 0, "open": True}, {"id": 1, "open": True}]
+    assert session["open"] is False
+
+    # also when an endpoint wrapper already made the response
+    @route.get("/versioned/", etag=lambda req: "v1")
+    def versioned(req):
+        return ({"id": i, "open": session["open"]} for i in range(2))
+
+    resp = app.get("/versioned/")
+    assert resp.json == [{"id": 0, "open": True}, {"id": 1, "open": True}]
+    assert resp.etag == "v1"
+    assert session["open"] is False
+
+
+def test_etag():
+    route = pibe.JSONRouter()
+    route.get("/hashed/", etag=True)(MagicMock(return_value={"foo": "bar"}))
+    route.get("/plain/")(MagicMock(return_value={"foo": "bar"}))
+
+    app = TestApp(route.application)
+    resp = app.get("/hashed/")
+    etag = resp.headers["ETag"]
+    assert resp.json == {"foo": "bar"}
+    assert "ETag" not in app.get("/plain/").headers
+
+    resp = app.get("/hashed/", headers={"If-None-Match": etag}, status=304)
+    assert resp.body == b""
+    assert app.get("/hashed/", headers={"If-None-Match": '"other"'}).status_code == 200
+
+
+def test_etag_version_key():
+    route = pibe.JSONRouter()
+    version_key = MagicMock(return_value="v1")
+    endpoint = MagicMock(return_value={"foo": "bar"})
+    route.get("/foo/<foo_id>/", etag=version_key)(endpoint)
+
+    app = TestApp(route.application)
+    resp = app.get("/foo/1/")
+    assert resp.headers["ETag"] == '"v1"'
+    assert resp.json == {"foo": "bar"}
+    assert version_key.call_args[1] == {"foo_id": "1"}
+
+    endpoint.reset_mock()
+    resp = app.get("/foo/1/", headers={"If-None-Match": '"v1"'}, status=304)
+    assert resp.headers["ETag"] == '"v1"'
+    assert endpoint.called is False
+
+    version_key.return_value = "v2"
+    resp = app.get("/foo/1/", headers={"If-None-Match": '"v1"'})
+    assert resp.headers["ETag"] == '"v2"'
+    assert endpoint.called
+
+
+def test_etag_version_key_methods():
+    route = pibe.JSONRouter()
+    endpoint = MagicMock(return_value={"foo": "bar"})
+    route.add("/doc/<doc_id>/", etag=lambda req, doc_id: 5)(endpoint)
+
+    app = TestApp(route.application)
+    assert app.get("/doc/1/").headers["ETag"] == '"5"'
+    app.get("/doc/1/", headers={"If-None-Match": '"5"'}, status=304)
+    assert endpoint.call_count == 1
+
+    # writes aren't dropped as not modified
+    app.put("/doc/1/", headers={"If-None-Match": '"5"'}, status=412)
+    app.put("/doc/1/", headers={"If-None-Match": "*"}, status=412)
+    assert endpoint.call_count == 1
+    resp = app.put("/doc/1/", headers={"If-None-Match": '"4"'})
+    assert "ETag" not in resp.headers
+    assert endpoint.call_count == 2
+
+
+def test_head():
+    route = pibe.JSONRouter()
+    route.add("/foo/", etag=True)(lambda req: {"foo": "bar"})
+
+    def items(req):
+        yield {"foo": "bar"}
+        raise AssertionError("HEAD shouldn't iterate streams")
+    route.add("/stream/")(items)
+
+    head = MagicMock(return_value={"foo": "bar"})
+    endpoint = MagicMock(return_value={"foo": "bar"})
+    route.add("/cheap/<foo_id>/", head=head)(endpoint)
+
+    app = TestApp(route.application)
+    get = app.get("/foo/")
+    resp = app.head("/foo/")
+    assert resp.body == b""
+    assert resp.content_length == get.content_length
+    assert resp.headers["ETag"] == get.headers["ETag"]
+
+    resp = app.head("/stream/")
+    assert resp.body == b""
+    assert resp.content_type == "application/json"
+
+    app.head("/cheap/1/")
+    assert head.call_args[1] == {"foo_id": "1"}
+    assert endpoint.called is False
+    app.get("/cheap/1/")
+    assert endpoint.called
+
+
+@pytest.mark.skipif(pibe.msgpack is None, reason="msgpack not installed")
+def test_msgpack_response():
+    route = pibe.JSONRouter()
+    route.get("/")(MagicMock(return_value={"foo": "bar", "date": datetime.date(2020, 1, 2)}))
+
+    app = TestApp(route.application)
+    resp = app.get("/", headers={"Accept": "application/msgpack"})
+    assert resp.content_type == "application/msgpack"
+    assert resp.headers["Vary"] == "Accept"
+    assert pibe.msgpack.unpackb(resp.body) == {"foo": "bar", "date": "2020-01-02"}
+
+    resp = app.get("/", headers={"Accept": "application/json, application/msgpack;q=0.5"})
+    assert resp.content_type == "application/json"
+    assert resp.headers["Vary"] == "Accept"
+    assert app.get("/").headers["Vary"] == "Accept"
+    assert app.get("/").json == {"foo": "bar", "date": "2020-01-02"}
+
+
 def test_before_request():
 
     route1 = pibe.Router()
@@ -292,6 +540,150 @@ def test_after_request_error():
 
 
 
+def test_route_hooks():
+    route = pibe.Router()
+    calls = []
+
+    @route.before_request()
+    def first_hook(req):
+        calls.append("first")
+
+    @route.after_request()
+    def second_hook(req):
+        calls.append("second")
+
+    route.get("/all/")(MagicMock(return_value="ok"))
+    route.get("/health/", hooks=False)(MagicMock(return_value="ok"))
+    route.get("/some/", exclude_hooks=["first_hook"])(MagicMock(return_value="ok"))
+
+    app = TestApp(route.application)
+    app.get("/all/")
+    assert calls == ["first", "second"]
+    app.get("/health/")
+    assert calls == ["first", "second"]
+    app.get("/some/")
+    assert calls == ["first", "second", "second"]
+
+    # hooks registered later are picked up
+    @route.before_request()
+    def third_hook(req):
+        calls.append("third")
+
+    app.get("/some/")
+    assert calls[-2:] == ["third", "second"]
+
+    route.freeze()
+    with pytest.raises(RuntimeError):
+        route.before_request()(MagicMock())
+
+
+def test_unnamed_hooks():
+    route = pibe.Router()
+    before = MagicMock()
+    after = MagicMock()
+    route.before_request.append(before)
+    route.after_request.append(after)
+    route.get("/all/")(MagicMock(return_value="ok"))
+    route.get("/some/", exclude_hooks=["first_hook"])(MagicMock(return_value="ok"))
+
+    app = TestApp(route.application)
+    app.get("/all/")
+    app.get("/some/")
+    assert (before.call_count, after.call_count) == (2, 2)
+
+    route.timings = pibe.RouteTimings()
+    app.get("/all/")
+    assert "before_request:MagicMock" in route.timings.snapshot()["/all/"]
+
+
+def test_shared_opts():
+    route = pibe.Router()
+
+    def shared(req):
+        req.opts.foo = "baaz"
+        return "ok"
+    route.get("/shared/", foo="bar", shared_opts=True)(shared)
+
+    def mutable(req):
+        req.opts.foo = "baaz"
+        return req.opts.foo
+    route.get("/mutable/", foo="bar")(mutable)
+
+    app = TestApp(route.application)
+    with pytest.raises(TypeError):
+        app.get("/shared/")
+    assert app.get("/mutable/").text == "baaz"
+    assert app.get("/mutable/").text == "baaz"
+    assert route[1][4]["foo"] == "bar"
+
+
+def test_mount():
+    route = pibe.Router()
+    admin = pibe.JSONRouter()
+    calls = []
+
+    @admin.before_request()
+    def admin_hook(req):
+        calls.append(req.script_name)
+
+    @admin.get("/users/<user_id>/")
+    def admin_user(req, user_id):
+        return {"user_id": user_id, "path": req.path_info}
+
+    route.get("/admin-page/")(MagicMock(return_value="page"))
+    route.mount("/admin/", admin)
+
+    app = TestApp(route.application)
+    resp = app.get("/admin/users/1/")
+    assert resp.json == {"user_id": "1", "path": "/users/1/"}
+    assert calls == ["/admin"]
+    assert app.get("/admin-page/").text == "page"
+    assert app.get("/admin/page/", expect_errors=True).status_code == 404
+
+    (status, headers, body) = asgi_call(route.asgi_application, "GET", "/admin/users/2/")
+    assert json.loads(body) == {"user_id": "2", "path": "/users/2/"}
+
+    with pytest.raises(ValueError):
+        route.mount("/", pibe.Router())
+    assert app.get("/admin-page/").text == "page"
+
+    route.freeze()
+    assert admin.frozen
+
+
+def test_route_timings():
+    route = pibe.JSONRouter()
+    route.timings = pibe.RouteTimings()
+
+    @route.before_request()
+    def load_session(req):
+        pass
+
+    route.get("/foo/<foo_id>/", name="foo")(MagicMock(return_value={"foo": "bar"}))
+    route.get("/bar/")(MagicMock(return_value={"bar": "foo"}))
+
+    app = TestApp(route.application)
+    app.get("/foo/1/")
+    app.get("/foo/2/")
+    app.get("/bar/")
+
+    snapshot = route.timings.snapshot()
+    assert sorted(snapshot) == ["/bar/", "foo"]
+    assert sorted(snapshot["foo"]) == [
+        "before_request:load_session", "endpoint", "resolve", "response_wrapper"]
+    assert snapshot["foo"]["endpoint"]["count"] == 2
+    assert snapshot["foo"]["endpoint"]["buckets"][-1] == (float("inf"), 2)
+
+    text = route.timings.prometheus()
+    assert '# TYPE pibe_route_phase_seconds histogram' in text
+    assert 'pibe_route_phase_seconds_count{route="foo",phase="endpoint"} 2' in text
+    assert 'pibe_route_phase_seconds_bucket{route="/bar/",phase="resolve",le="+Inf"} 1' in text
+
+    route.timings = pibe.RouteTimings(sample_rate=0)
+    app.get("/bar/")
+    assert route.timings.snapshot() == {}
+
+
 def test_opts():
     route = pibe.Router()
     def home(req):
@@ -302,3 +694,204 @@ def test_opts():
     app = TestApp(route.application)
     resp = app.get("/")
     assert resp.status_code == 200
+
+
+@pytest.mark.parametrize("matcher_class", [pibe.RegexMatcher, pibe.TreeMatcher])
+def test_matcher_keeps_order(matcher_class):
+    route = pibe.Router(matcher_class=matcher_class)
+    route.get("/foo/<foo_id:int>/")(MagicMock(return_value="int"))
+    route.get("/foo/<slug:slug>/")(MagicMock(return_value="slug"))
+    route.get(r"/bar/<value:re((\w)\2)>/")(MagicMock(return_value="re"))
+    route.post("/bar/<value>/")(MagicMock(return_value="post"))
+    route.get("/bar/<value>/")(MagicMock(return_value="default"))
+
+    app = TestApp(route.application)
+
+    assert app.get("/foo/12/").text == "int"
+    assert app.get("/foo/abc/").text == "slug"
+    assert app.get("/bar/aa/").text == "re"
+    assert app.get("/bar/ab/").text == "default"
+    assert app.post("/bar/aa/").text == "post"
+    resp = app.put("/bar/aa/", expect_errors=True)
+    assert resp.status_code == 405
+    assert resp.headers["Allow"] == "GET, POST"
+    assert app.get("/baaz/", expect_errors=True).status_code == 404
+
+    (func, kwargs, opts) = route.resolve(Request.blank("/foo/12/"))
+    assert kwargs == {"foo_id": "12"}
+
+
+def test_tree_matcher():
+    route = pibe.Router(matcher_class=pibe.TreeMatcher)
+    route.get("/files/<name:path>")(MagicMock(return_value="path"))
+    route.get("/files/<name>/raw")(MagicMock(return_value="raw"))
+    route.get("/items/<item_id:int>.json")(MagicMock(return_value="json"))
+    route.get("/items/<item_id:int>/")(MagicMock(return_value="int"))
+    route.get("/items/latest/")(MagicMock(return_value="latest"))
+    route.get("/")(MagicMock(return_value="root"))
+
+    app = TestApp(route.application)
+
+    # registered earlier, the path route shadows the raw one
+    assert app.get("/files/foo/raw").text == "path"
+    assert app.get("/items/12.json").text == "json"
+    assert app.get("/items/12/").text == "int"
+    assert app.get("/items/latest/").text == "latest"
+    assert app.get("/").text == "root"
+    assert app.get("/items/", expect_errors=True).status_code == 404
+    assert app.post("/items/12/", expect_errors=True).status_code == 405
+
+    (func, kwargs, opts) = route.resolve(Request.blank("/items/12.json"))
+    assert kwargs == {"item_id": "12"}
+
+
+def test_resolve_cache():
+    route = pibe.Router(resolve_cache_size=2)
+    route.get("/foo/<foo_id:int>/")(MagicMock(return_value="foo"))
+
+    app = TestApp(route.application)
+    assert app.get("/foo/1/").text == "foo"
+    assert app.get("/foo/1/").text == "foo"
+    assert app.get("/bar/", expect_errors=True).status_code == 404
+    assert app.get("/bar/", expect_errors=True).status_code == 404
+    assert app.post("/foo/1/", expect_errors=True).headers["Allow"] == "GET"
+    assert route.resolve_cache.stats() == {"hits": 2, "misses": 3, "size": 2, "maxsize": 2}
+
+    (func, kwargs, opts) = route.resolve(Request.blank("/foo/1/"))
+    kwargs["foo_id"] = "2"
+    assert route.resolve(Request.blank("/foo/1/"))[1] == {"foo_id": "1"}
+
+    # registering a route drops the cached outcomes
+    route.get("/bar/")(MagicMock(return_value="bar"))
+    assert app.get("/bar/").text == "bar"
+
+
+def test_freeze():
+    route = pibe.Router()
+    route.get("/foo/<foo_id>/", name="foo")(MagicMock(return_value="foo"))
+    route.get("/foo/<foo_id:int>/")(MagicMock(return_value="int"))
+    route("/foo/bar/", ["GET", "POST"], name="foo")(MagicMock(return_value="bar"))
+
+    assert route.shadowed_routes() == [
+        ("/foo/<foo_id:int>/", ["GET"], "/foo/<foo_id>/"),
+        ("/foo/bar/", ["GET"], "/foo/<foo_id>/"),
+    ]
+    route.post("/foo/<foo_id>/")(MagicMock(return_value="post"))
+    route.get("/foo/bar/")(MagicMock(return_value="bar"))
+    assert route.shadowed_routes() == [
+        ("/foo/<foo_id:int>/", ["GET"], "/foo/<foo_id>/"),
+        ("/foo/bar/", ["GET"], "/foo/<foo_id>/"),
+        ("/foo/bar/", ["GET"], "/foo/<foo_id>/"),
+    ]
+    del route[-2:]
+    with pytest.raises(ValueError):
+        route.freeze(strict=True)
+    assert route.frozen is False
+
+    route.freeze()
+    assert route.frozen
+
+    with pytest.raises(RuntimeError):
+        route.get("/baaz/")
+    with pytest.raises(RuntimeError):
+        route.append(route[0])
+
+    app = TestApp(route.application)
+    assert app.get("/foo/bar/").text == "foo"
+    assert app.post("/foo/bar/").text == "bar"
+
+
+def test_shadowed_dynamic_routes():
+    route = pibe.Router()
+    route.get("/a/<a_id>/<name:str>/")(MagicMock())
+    route.get("/a/<a_id:int>/<year:year>/")(MagicMock())
+    route.get("/a/<a_id:int>/<name:slug>/")(MagicMock())
+    route.get("/b/<b_id:int>/")(MagicMock())
+    route.get("/b/<b_id>/")(MagicMock())
+    route.get("/c/<file_path:path>")(MagicMock())
+    route.get("/c/<c_id:uuid>")(MagicMock())
+    route.get("/d/<d_id>")(MagicMock())
+    route.get("/d/<file_path:path>")(MagicMock())
+    assert route.shadowed_routes() == [
+        ("/a/<a_id:int>/<year:year>/", ["GET"], "/a/<a_id>/<name:str>/"),
+        ("/c/<c_id:uuid>", ["GET"], "/c/<file_path:path>"),
+    ]
+
+
+def asgi_call(app, method, path, body=b"", headers=()):
+    messages = [{"type": "http.request", "body": body, "more_body": False}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {
+        "type": "http",
+        "method": method,
+        "path": path,
+        "query_string": b"",
+        "headers": list(headers),
+    }
+    asyncio.run(app(scope, receive, send))
+    headers = dict([(k.decode(), v.decode()) for (k, v) in sent[0]["headers"]])
+    return (sent[0]["status"], headers, b"".join(m.get("body", b"") for m in sent[1:]))
+
+
+def test_asgi_plain_router():
+    route = pibe.Router()
+    route.get("/str/")(MagicMock(return_value="ok"))
+    route.get("/none/")(MagicMock(return_value=None))
+
+    (status, headers, body) = asgi_call(route.asgi_application, "GET", "/str/")
+    assert (status, body) == (200, b"ok")
+    (status, headers, body) = asgi_call(route.asgi_application, "GET", "/none/")
+    assert (status, body) == (200, b"")
+
+
+def test_asgi_application():
+    route = pibe.JSONRouter()
+    calls = []
+
+    @route.before_request()
+    def before_request(req):
+        calls.append(threading.current_thread())
+
+    @route.get("/sync/<foo_id:int>/")
+    def sync_endpoint(req, foo_id):
+        return {"foo_id": foo_id, "thread": threading.current_thread() == calls[-1]}
+
+    @route.post("/async/")
+    async def async_endpoint(req):
+        await asyncio.sleep(0)
+        return req.json
+
+    (status, headers, body) = asgi_call(route.asgi_application, "GET", "/sync/1/")
+    assert status == 200
+    assert headers["content-type"] == "application/json"
+    assert json.loads(body) == {"foo_id": "1", "thread": True}
+    assert calls[-1] != threading.main_thread()
+
+    (status, headers, body) = asgi_call(
+        route.asgi_application, "POST", "/async/", body=b'{"foo": "bar"}',
+        headers=[(b"content-type", b"application/json")])
+    assert status == 200
+    assert json.loads(body) == {"foo": "bar"}
+    assert calls[-1] == threading.main_thread()
+
+    (status, headers, body) = asgi_call(route.asgi_application, "GET", "/async/")
+    assert status == 405
+    assert headers["allow"] == "POST"
+
+    route.max_body_size = 10
+    (status, headers, body) = asgi_call(route.asgi_application, "POST", "/async/", body=b'{"a": "bc"}')
+    assert status == 413
+
+    # and through wsgi, with and without timings
+    app = TestApp(route.application)
+    assert app.post_json("/async/", {"foo": "bar"}).json == {"foo": "bar"}
+    route.timings = pibe.RouteTimings()
+    assert app.post_json("/async/", {"foo": "baz"}).json == {"foo": "baz"}
+    assert "endpoint" in route.timings.snapshot()["/async/"]
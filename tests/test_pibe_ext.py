@@ -1,6 +1,7 @@
 from pibe_ext.appconfig import *
 from pibe_ext.redis import *
 from pibe_ext.cache import *
+from pibe_ext.compression import *
 from pibe_ext.correlation import *
 from pibe_ext.crud import *
 from pibe_ext.db import *
@@ -9,10 +10,12 @@ from pibe_ext.debugger import *
 from pibe_ext.docs import *
 from pibe_ext.http import *
 from pibe_ext.i18n import *
+from pibe_ext.metrics import *
 from pibe_ext.rpc import *
 from pibe_ext.sentry import *
 from pibe_ext.session import *
 from pibe_ext.settings import *
+from pibe_ext.sse import *
 from pibe_ext.utils import *
 from pibe_ext.validator import *
 from pibe_ext.webhooks import *
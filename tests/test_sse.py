@@ -0,0 +1,95 @@
+import gevent
+import pibe
+from unittest.mock import patch
+from webtest import TestApp
+from pibe_ext.sse import Event, EventStream, format_event, event_stream
+from pibe_ext.settings import settings
+from pibe_ext.session import g
+
+
+def test_format_event():
+    assert format_event({"foo": "bar"}) == b"data: " + pibe.json_encoder({"foo": "bar"}) + b"\n\n"
+    assert format_event("a\nb") == b"data: a\ndata: b\n\n"
+    assert format_event(Event("x", event="update", id=3, retry=1000)) == b"event: update\nid: 3\nretry: 1000\ndata: x\n\n"
+
+
+def test_event_stream():
+    route = pibe.JSONRouter()
+
+    @route.add("/events/", sse_heartbeat=0.01)
+    @event_stream
+    def events(req):
+        yield "one"
+        gevent.sleep(0.05)
+        yield Event("two", event="update")
+
+    app = TestApp(route.application)
+    resp = app.get("/events/")
+    assert resp.content_type == "text/event-stream"
+    assert resp.headers["Cache-Control"] == "no-cache"
+    assert resp.body.startswith(b"data: one\n\n: heartbeat\n\n")
+    assert resp.body.endswith(b"event: update\ndata: two\n\n")
+    assert EventStream.active == 0
+
+    assert app.head("/events/").body == b""
+
+
+def test_event_stream_close():
+    closed = []
+
+    def events():
+        try:
+            while True:
+                gevent.sleep(1)
+                yield "tick"
+        finally:
+            closed.append(True)
+
+    stream = EventStream(events(), heartbeat=0.01)
+    assert EventStream.active == 1
+    assert next(stream) == b": heartbeat\n\n"
+
+    # the server closes the app_iter when the client goes away
+    stream.close()
+    gevent.sleep(0)
+    assert closed == [True]
+    assert EventStream.active == 0
+
+
+def test_event_stream_max_connections():
+    route = pibe.JSONRouter()
+
+    @route.get("/events/")
+    @event_stream
+    def events(req):
+        yield "one"
+
+    app = TestApp(route.application)
+    with patch.dict(settings, sse_max_connections=1):
+        stream = EventStream(iter([]), heartbeat=1)
+        assert app.get("/events/", status=503).json["errors"]
+        stream.close()
+        assert app.get("/events/").body == b"data: one\n\n"
+
+
+def test_event_stream_request_locals():
+    route = pibe.JSONRouter()
+    calls = []
+
+    @route.before_request()
+    def set_request(req):
+        g.request = req
+
+    @route.after_request()
+    def cleanup(req):
+        calls.append("cleanup")
+
+    @route.get("/events/")
+    @event_stream
+    def events(req):
+        yield {"request": g.request is req, "calls": list(calls)}
+
+    app = TestApp(route.application)
+    resp = app.get("/events/")
+    assert resp.body == b"data: " + pibe.json_encoder({"request": True, "calls": []}) + b"\n\n"
+    assert calls == ["cleanup"]